@@ -0,0 +1,48 @@
+## @package bench_import
+#  Import-time benchmark of the solve path
+#
+#  Usage: python benchmarks/bench_import.py [MAXTIME]
+#
+#  Imports the modules needed for a solve-only run in a fresh interpreter,
+#  reports the import time and fails when a graphical module is imported or
+#  when the import time exceeds MAXTIME seconds.
+
+import os
+import sys
+import json
+import subprocess
+
+## Modules imported by a solve-only run
+solve_modules = ( 'myFElib', 'myLinAlglib', 'mymodelslib', 'myIOlib' )
+
+## Modules that must not be imported by a solve-only run
+graphical_modules = ( 'matplotlib', 'tkinter', 'PIL' )
+
+## Root directory of the finite element program
+rootdir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+## Measure the import of the solve path in a fresh interpreter
+#  @return Import time in seconds
+#  @return List of imported graphical packages
+def measure_import ( ):
+    code = '\n'.join( [ 'import sys, time',
+                        't0 = time.perf_counter()',
+                        'import ' + ', '.join( solve_modules ),
+                        't1 = time.perf_counter()',
+                        'import json',
+                        'print( json.dumps( [ t1-t0, sorted( sys.modules ) ] ) )' ] )
+    output = subprocess.check_output( [ sys.executable, '-c', code ], cwd=rootdir )
+    seconds, modules = json.loads( output )
+    graphical = sorted( set( name.split('.')[0] for name in modules ) & set( graphical_modules ) )
+    return seconds, graphical
+
+if __name__ == '__main__':
+    maxtime = float( sys.argv[1] ) if len(sys.argv) > 1 else None
+
+    seconds, graphical = measure_import()
+    print( 'Import time         [s]    : ', seconds )
+
+    if graphical:
+        sys.exit( 'Graphical modules imported: {}'.format( ', '.join( graphical ) ) )
+    if maxtime is not None and seconds > maxtime:
+        sys.exit( 'Import time exceeds {} s'.format( maxtime ) )
@@ -0,0 +1,187 @@
+## @package bench_meshes
+#  Per-stage benchmark of the solver pipeline over the bundled meshes
+#
+#  Usage: python benchmarks/bench_meshes.py [options] [MESH ...]
+#
+#  Every mesh (default: all meshes in the meshes directory) is run through
+#  read_from_txt, PipeFlow.assemble, LinearSystem.solve and
+#  calculate_flow_properties (the computation behind geometry_factor). The
+#  text parser is measured as a separate stage (read_from_txt without the
+#  compiled mesh file), as the read stage loads the compiled mesh file. The
+#  wall time of every stage is measured over a number of repeats after one
+#  warm-up run, which also creates the compiled mesh files. The peak memory
+#  of every stage is measured in a separate run with tracemalloc, such that
+#  the tracing does not affect the timings.
+#
+#  The report is written as JSON. When a baseline report is given, the
+#  median times are compared and the benchmark fails if any stage is slower
+#  than the baseline by more than the tolerance.
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy
+import scipy
+
+## Root directory of the finite element program
+rootdir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+sys.path.insert( 0, rootdir )
+
+from myIOlib import read_from_txt
+from myFElib import calculate_flow_properties
+from mymodelslib import PipeFlow
+
+## Pipeline stages, in order
+stages = ( 'parse', 'read', 'assemble', 'solve', 'post' )
+
+## Model parameters of the benchmark
+params = { 'length'        : 1.,
+           'pressure_drop' : 1.,
+           'viscosity'     : 1e-3 }
+
+## Run the pipeline once on a mesh
+#  @param  fname  Name of the mesh file
+#  @param  memory Measure the peak memory instead of the time per stage
+#  @return        Dictionary with the time (s) or peak memory (bytes) per stage
+#  @return        Dictionary with the mesh size
+def run_pipeline ( fname, memory=False ):
+    measures = {}
+
+    def start ( ):
+        if memory:
+            tracemalloc.start()
+        return time.perf_counter()
+
+    def stop ( stage, t0 ):
+        if memory:
+            measures[stage] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            measures[stage] = time.perf_counter() - t0
+
+    t0 = start()
+    read_from_txt( fname, cache=False )
+    stop( 'parse', t0 )
+
+    t0 = start()
+    mesh, cons = read_from_txt( fname )
+    mesh.enable_geometry_cache()
+    stop( 'read', t0 )
+
+    t0 = start()
+    linsys = PipeFlow( params, mesh, cons ).assemble()
+    stop( 'assemble', t0 )
+
+    t0 = start()
+    sol = linsys.solve()
+    stop( 'solve', t0 )
+
+    t0 = start()
+    calculate_flow_properties( mesh, sol, cons, params )
+    stop( 'post', t0 )
+
+    size = { 'nnodes' : mesh.get_nr_of_nodes(),
+             'nelems' : len( mesh.get_connectivity() ),
+             'ndofs'  : len( linsys.get_free_dofs() ) }
+    return measures, size
+
+## Benchmark a mesh
+#  @param  fname  Name of the mesh file
+#  @param  repeat Number of timed runs
+#  @return        Dictionary with the mesh size and the statistics per stage
+def bench_mesh ( fname, repeat ):
+    run_pipeline( fname )
+
+    times = { stage : [] for stage in stages }
+    for i in range( repeat ):
+        measures, size = run_pipeline( fname )
+        for stage in stages:
+            times[stage].append( measures[stage] )
+    memory, size = run_pipeline( fname, memory=True )
+
+    result = dict( size )
+    result['stages'] = {}
+    for stage in stages:
+        median = float( numpy.median( times[stage] ) )
+        result['stages'][stage] = { 'times'           : times[stage],
+                                    'min'             : min( times[stage] ),
+                                    'median'          : median,
+                                    'peak_memory'     : memory[stage],
+                                    'dofs_per_second' : size['ndofs'] / median if median > 0 else None }
+    return result
+
+## Compare a report with a baseline report
+#  @param  report    Benchmark report
+#  @param  baseline  Baseline benchmark report
+#  @param  tolerance Allowed relative increase of the median time
+#  @return           List of (mesh, stage, ratio) of the regressions
+def compare_reports ( report, baseline, tolerance ):
+    regressions = []
+    for name, result in report['meshes'].items():
+        if name not in baseline['meshes']:
+            continue
+        for stage in stages:
+            if stage not in baseline['meshes'][name]['stages']:
+                continue
+            reference = baseline['meshes'][name]['stages'][stage]['median']
+            ratio = result['stages'][stage]['median'] / reference if reference > 0 else 1.
+            result['stages'][stage]['baseline_ratio'] = ratio
+            if ratio > 1. + tolerance:
+                regressions.append( ( name, stage, ratio ) )
+    return regressions
+
+## Print a report as a table
+#  @param report Benchmark report
+def print_report ( report ):
+    print( '{:<22} {:>7} {:<9} {:>11} {:>11} {:>13} {:>9}'.format(
+           'mesh', 'dofs', 'stage', 'median [s]', 'peak [MiB]', 'dofs/s', 'baseline' ) )
+    for name, result in report['meshes'].items():
+        for stage in stages:
+            entry = result['stages'][stage]
+            ratio = entry.get( 'baseline_ratio' )
+            print( '{:<22} {:>7} {:<9} {:>11.2e} {:>11.2f} {:>13.3e} {:>9}'.format(
+                   name, result['ndofs'], stage, entry['median'], entry['peak_memory'] / 2.**20,
+                   entry['dofs_per_second'] or 0., '' if ratio is None else '{:.2f}x'.format( ratio ) ) )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description='Per-stage benchmark of the solver pipeline' )
+    parser.add_argument( 'meshes', nargs='*', help='mesh files (default: all bundled meshes)' )
+    parser.add_argument( '--repeat', type=int, default=5, help='number of timed runs per mesh' )
+    parser.add_argument( '--output', default=None, help='name of the JSON report' )
+    parser.add_argument( '--baseline', default=None, help='JSON report to compare with' )
+    parser.add_argument( '--tolerance', type=float, default=0.25, help='allowed relative slowdown' )
+    args = parser.parse_args()
+
+    meshes = args.meshes or sorted( glob.glob( os.path.join( rootdir, 'meshes', '*.txt' ) ) )
+
+    report = { 'python'   : platform.python_version(),
+               'numpy'    : numpy.__version__,
+               'scipy'    : scipy.__version__,
+               'machine'  : platform.machine(),
+               'repeat'   : args.repeat,
+               'params'   : params,
+               'meshes'   : {} }
+    for fname in meshes:
+        name = os.path.splitext( os.path.basename( fname ) )[0]
+        report['meshes'][name] = bench_mesh( fname, args.repeat )
+
+    regressions = []
+    if args.baseline is not None:
+        with open( args.baseline ) as fin:
+            regressions = compare_reports( report, json.load( fin ), args.tolerance )
+
+    print_report( report )
+
+    if args.output is not None:
+        with open( args.output, 'w' ) as fout:
+            json.dump( report, fout, indent=2 )
+        print( 'Report written to {}'.format( args.output ) )
+
+    if regressions:
+        sys.exit( 'Regressions: {}'.format( ', '.join( '{} {} {:.2f}x'.format( *entry ) for entry in regressions ) ) )
@@ -12,7 +12,6 @@ import numpy as np
 from scipy.integrate import dblquad
 from myLinAlglib import LinearSystem
 #from myFElib import *
-import math
 
 
 ## https://math.stackexchange.com/questions/516219/finding-out-the-area-of-a-triangle-if-the-coordinates-of-the-three-vertices-are
@@ -64,77 +63,26 @@ def calculate_average_velocity(mesh, sol):
     
 ## Determine Boundary Node Values
 def Boundary_Nodes(mesh, cons):
-    C = mesh.get_connectivity()
-    B = cons
-    
-    Boundary_Node=[]
-    for i in range(0, len(C)):
-        boolarr = np.in1d(C[i,:],B)
-        if np.sum(boolarr) > 1:
-            position = np.where(np.in1d(C[i,:],B))
-            place = position[0]
-            Boundary_Node.append([C.item(i,place[0]) , C.item(i,place[1])])
-
-    return Boundary_Node
+    return mesh.get_boundary_edges()['ends'][mesh.get_constrained_edges(cons)].tolist()
 
 
 ## Calculate circumference
 def calculate_circumference(mesh, cons):
-    X = mesh.get_nodal_coordinates()
-    Z = np.array(Boundary_Nodes(mesh, cons))
-
-    length=0
-    for i in range(0, len(Z)):
-        length_i = math.sqrt(( X.item(Z[i,0],0) - X.item(Z[i,1],0))**2 + 
-                            ( X.item(Z[i,0],1) - X.item(Z[i,1],1))**2  )
-        length += length_i
-        
-    return length
-
-## Calculate the normal vector on the element
-def calculate_normal(mesh, cons, nodes):
-    X = mesh.get_nodal_coordinates()    
-
-    dx = X.item(nodes[0], 0) - X.item(nodes[1], 0)
-    dy = X.item(nodes[0], 1) - X.item(nodes[1], 1)
-        
-    if (X.item(nodes[0], 0) > 0 and X.item(nodes[1], 0) > 0):
-        if np.sign([dy]) > 0:
-            norm = [dy, -dx]
-        else:
-            norm = [-dy, dx]
-    elif (X.item(nodes[0], 0) < 0 and X.item(nodes[1], 0) < 0):
-        if np.sign([dy]) < 0:
-            norm = [dy, -dx]
-        else:
-            norm = [-dy, dx]        
-    elif (X.item(nodes[0], 1) > 0 and X.item(nodes[1], 1) > 0):
-        if np.sign([dx]) < 0:
-            norm = [dy, -dx]
-        else:
-            norm = [-dy, dx]        
-    elif X.item(nodes[0], 1) < 0 and X.item(nodes[1], 1) < 0:
-        if np.sign([dx]) > 0:
-            norm = [dy, -dx]
-        else:
-            norm = [-dy, dx]
-    else:
-        norm = [0, 0]
-    
-    return norm
+    return mesh.get_boundary_edges()['lengths'][mesh.get_constrained_edges(cons)].sum()
 
 
 ## Calculate the cross sectional area
-def cross_sectional_area(mesh, cons):
+#
+#  The divergence theorem needs a closed curve, so all boundary edges are
+#  used: the constrained edges (the wall) are an open chain on meshes with
+#  symmetry boundaries.
+def cross_sectional_area(mesh, cons=None):
     X = mesh.get_nodal_coordinates()
-    Z = np.array(Boundary_Nodes(mesh, cons))
-    
-    Ac = 0
-    for i in range(0, len(Z)):
-        norm = calculate_normal(mesh, cons, Z[i, 0:2])
-        coor = (X[Z[i, 0], 0:2] + X[Z[i, 1], 0:2]) / 2
-        Ac_i = np.dot(coor, norm)  
-        Ac += Ac_i
+    Z = mesh.get_boundary_edges()['ends']
+    coor = (X[Z[:, 0], 0:2] + X[Z[:, 1], 0:2]) / 2
+    dX = X[Z[:, 1], 0:2] - X[Z[:, 0], 0:2]
+    norm = np.column_stack((dX[:, 1], -dX[:, 0]))
+    Ac = np.sum(coor * norm)
     
     Ac = Ac/2
     
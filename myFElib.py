@@ -2,19 +2,31 @@
 #  This module contains the basic finite element data structures
 
 import numpy as np
-import math
+import scipy.sparse
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+from myLinAlglib import SparsityPattern
+from myProfilelib import profiled, count
 
 ## Finite element node
+#
+#  A node either owns its coordinate, or is a view on a row of the
+#  coordinate array of a Mesh.
 class Node:
 
+    __slots__ = ( '__ID', '__dof', '__coord', '__mesh' )
+
     ## Constructor
     #  @param ID    Node ID
-    #  @param coord Node coordinate
+    #  @param coord Node coordinate (ignored for a mesh view)
     #  @param dof   Dof index
-    def __init__ ( self, ID, coord, dof ):
+    #  @param mesh  Mesh of which the node is a view (optional)
+    def __init__ ( self, ID, coord, dof, mesh=None ):
         self.__ID = ID
         self.__dof = dof
-        self.set_coordinate( coord )
+        self.__mesh = mesh
+        self.__coord = None
+        if mesh is None:
+            self.set_coordinate( coord )
 
     ## String function
     def __str__ ( self ):
@@ -34,15 +46,22 @@ class Node:
         assert isinstance( coord, np.ndarray )
         assert coord.ndim==1
         assert coord.dtype==float
-        self.__coord = coord
+        if self.__mesh is None:
+            self.__coord = coord
+        else:
+            self.__mesh.set_nodal_coordinate( self.__dof, coord )
 
     ## Get the Node coordinate
     def get_coordinate( self ):
-        return self.__coord
+        if self.__mesh is None:
+            return self.__coord
+        return self.__mesh.get_nodal_coordinates()[self.__dof]
         
 ## Finite element triangular parent element
 #        
-#  Linear triangle parent element with local coordinates (0,0), (1,0), (0,1)         
+#  Linear triangle parent element with local coordinates (0,0), (1,0), (0,1).
+#  The shape functions and gradients in the points of every integration
+#  scheme are tabulated on construction.
 class StandardTriangle:
     
     ## Dictionary of integration schemes
@@ -56,7 +75,15 @@ class StandardTriangle:
                  }
 
     ## Number of nodes
-    __nnodes = 3#6 ##
+    __nnodes = 3
+
+    ## Constructor
+    def __init__ ( self ):
+        self.__tables = {}
+        for key, (xis, ws) in self.__ischemes.items():
+            N  = np.array([self.get_shapes( xi ) for xi in xis])
+            dN = np.array([self.get_shapes_gradient( xi ) for xi in xis])
+            self.__tables[key] = ( N, dN )
     
     ## Length function
     def __len__ ( self ):
@@ -70,29 +97,13 @@ class StandardTriangle:
     #  @param  xi Local coordinate vector
     #  @return    Vector of shape functions
     def get_shapes ( self, xi ):
-        ## Linear 
         return np.array([1-xi[0]-xi[1],xi[0],xi[1]])
-#        ## Quadratic
-#        return np.array([(1 - 3*(xi[0]+xi[1]) + 4*xi[0]*xi[1] + 2*(xi[0]**2 + xi[1]**2)), 
-#                            (4*xi[0] - 4*xi[0]**2 - 4*xi[1]*xi[0]), 
-#                            xi[0]*(2*xi[0] - 1), 
-#                            4*(1 - xi[0] - xi[1])*xi[1], 
-#                            4*xi[0]*xi[1], 
-#                            xi[1]*(2*xi[1] - 1)])  
     
     ## Get the shape functions gradient
     #  @param  xi Local coordinate vector
     #  @return    Matrix of shape function gradients
     def get_shapes_gradient ( self, xi ):
-        ## Linear
         return np.array([[-1.,-1.], [ 1., 0.], [ 0., 1.]])
-#        ## Quadratic
-#        return np.array([[-3 + 4*(xi[0] + xi[1]), -3 + 4*(xi[0] + xi[1])],
-#                            [-8*xi[0] - 4*xi[1] + 4, -4*xi[0]],
-#                            [4*xi[0] - 1, 0],
-#                            [-4*xi[1], 4 -8*xi[1] - 4*xi[0]],
-#                            [4*xi[1], 4*xi[0]],
-#                            [0, 4*xi[1] - 1]])  
 
     ## Get the integration scheme
     #  @param  name The type of integration scheme (e.g. 'gauss')
@@ -102,26 +113,126 @@ class StandardTriangle:
     def get_integration_scheme ( self, name, npts ):
         xis, ws = self.__ischemes[ (name,npts) ]
         return xis, ws
+
+    ## Get the shape functions and gradients in all integration points
+    #  @param  name The type of integration scheme (e.g. 'gauss')
+    #  @param  npts The number of integration points
+    #  @return      Matrix (npts,nnodes) of shape functions
+    #  @return      Array (npts,nnodes,2) of shape function gradients
+    def get_shapes_table ( self, name, npts ):
+        return self.__tables[ (name,npts) ]
+
+    ## Get the element edges
+    #  @return Matrix (int) (3,nedgenodes) of local node indices per edge,
+    #          ordered along the edge in counter-clockwise direction
+    def get_edges ( self ):
+        return np.array([[0,1],[1,2],[2,0]])
+
+    ## Get the local coordinates of the nodes
+    #  @return Matrix (nnodes,2) of local node coordinates
+    def get_local_coordinates ( self ):
+        return np.array([[0.,0.],[1.,0.],[0.,1.]])
+
+    ## Get the linear sub-triangles of the element
+    #  @return Matrix (int) (nsub,3) of local node indices per sub-triangle,
+    #          in counter-clockwise order
+    def get_subtriangles ( self ):
+        return np.array([[0,1,2]])
+
+## Finite element quadratic triangular parent element
+#
+#  Quadratic triangle parent element with the nodes ordered as (0,0),
+#  (1/2,0), (1,0), (0,1/2), (1/2,1/2), (0,1).
+class StandardTriangleP2 ( StandardTriangle ):
+
+    ## Number of nodes
+    __nnodes = 6
+
+    ## Get the number of nodes
+    def get_nr_of_nodes ( self ):
+        return self.__nnodes
+
+    ## Get the shape functions
+    #  @param  xi Local coordinate vector
+    #  @return    Vector of shape functions
+    def get_shapes ( self, xi ):
+        return np.array([(1 - 3*(xi[0]+xi[1]) + 4*xi[0]*xi[1] + 2*(xi[0]**2 + xi[1]**2)), 
+                            (4*xi[0] - 4*xi[0]**2 - 4*xi[1]*xi[0]), 
+                            xi[0]*(2*xi[0] - 1), 
+                            4*(1 - xi[0] - xi[1])*xi[1], 
+                            4*xi[0]*xi[1], 
+                            xi[1]*(2*xi[1] - 1)])  
+
+    ## Get the shape functions gradient
+    #  @param  xi Local coordinate vector
+    #  @return    Matrix of shape function gradients
+    def get_shapes_gradient ( self, xi ):
+        return np.array([[-3 + 4*(xi[0] + xi[1]), -3 + 4*(xi[0] + xi[1])],
+                            [-8*xi[0] - 4*xi[1] + 4, -4*xi[0]],
+                            [4*xi[0] - 1, 0],
+                            [-4*xi[1], 4 -8*xi[1] - 4*xi[0]],
+                            [4*xi[1], 4*xi[0]],
+                            [0, 4*xi[1] - 1]])
+
+    ## Get the element edges
+    #  @return Matrix (int) (3,nedgenodes) of local node indices per edge,
+    #          ordered along the edge in counter-clockwise direction
+    def get_edges ( self ):
+        return np.array([[0,1,2],[2,4,5],[5,3,0]])
+
+    ## Get the local coordinates of the nodes
+    #  @return Matrix (nnodes,2) of local node coordinates
+    def get_local_coordinates ( self ):
+        return np.array([[0.,0.],[.5,0.],[1.,0.],[0.,.5],[.5,.5],[0.,1.]])
+
+    ## Get the linear sub-triangles of the element
+    #
+    #  The element is split into three corner triangles and the triangle
+    #  through the midside nodes.
+    #
+    #  @return Matrix (int) (4,3) of local node indices per sub-triangle,
+    #          in counter-clockwise order
+    def get_subtriangles ( self ):
+        return np.array([[0,1,3],[1,2,4],[3,4,5],[1,4,3]])
+
+## Get the standard/parent element for a number of element nodes
+#  @param  nnodes Number of nodes per element
+#  @return        Standard/parent element
+def get_standard_element ( nnodes ):
+    if nnodes==3:
+        return StandardTriangle()
+    elif nnodes==6:
+        return StandardTriangleP2()
+    raise RuntimeError( 'No standard element with %d nodes' % nnodes )
         
 ## Isoparametric finite element
 #
-#  Maps a standard (parent) element using a node-based parametric map             
+#  Maps a standard (parent) element using a node-based parametric map. An
+#  element either owns a list of nodes, or is a view on a row of the
+#  connectivity array of a Mesh.
 class Element:
+
+    __slots__ = ( '__ID', '__nodes', '__parent', '__nnodes', '__mesh', '__index' )
     
     ## Constructor
     #  @param ID     Element ID
     #  @param parent Standard/parent element
-    #  @param nodes  List of finite element Nodes
-    def __init__ ( self, ID, parent, nodes ):
+    #  @param nodes  List of finite element Nodes (ignored for a mesh view)
+    #  @param mesh   Mesh of which the element is a view (optional)
+    #  @param index  Element index in the mesh (for a mesh view)
+    def __init__ ( self, ID, parent, nodes, mesh=None, index=None ):
         self.__ID     = ID
         self.__nodes  = nodes
         self.__parent = parent
         self.__nnodes = len(parent)
-        assert len(parent)==len(nodes)
+        self.__mesh   = mesh
+        self.__index  = index
+        if mesh is None:
+            assert len(parent)==len(nodes)
 
     ## Iterator function
     def __iter__ ( self ):
-        return iter(self.__nodes)    
+        return iter(self.__get_nodes())    
 
     ## Length function
     def __len__ ( self ):
@@ -129,25 +240,37 @@ class Element:
     
     ## Get item function
     def __getitem__ ( self, index ):
-        return self.__nodes[index]
+        return self.__get_nodes()[index]
     
     ## String function    
     def __str__ ( self ):
         s  = 'Element %d with nodes: ' % self.__ID 
-        s += ', '.join(str(node) for node in self.__nodes)
+        s += ', '.join(str(node) for node in self)
         return s
 
+    ## Get the Element ID
+    def get_ID ( self ):
+        return self.__ID
+
     ## Get the number of nodes    
     def get_nr_of_nodes ( self ):
         return self.__nnodes    
 
+    ## Get the standard/parent element
+    def get_parent( self ):
+        return self.__parent
+
     ## Get the vector of Dof indices
     def get_dofs( self ):
-        return [node.get_dof() for node in self]
+        if self.__mesh is None:
+            return [node.get_dof() for node in self]
+        return self.__mesh.get_connectivity()[self.__index].tolist()
 
     ## Get the matrix of nodal coordinates
     def get_coordinates( self ):
-        return np.array([node.get_coordinate() for node in self])
+        if self.__mesh is None:
+            return np.array([node.get_coordinate() for node in self])
+        return self.__mesh.get_nodal_coordinates()[self.__mesh.get_connectivity()[self.__index]]
     
     ## Get the global coordinate
     #  @param  xi Local coordinate vector    
@@ -164,6 +287,8 @@ class Element:
     #  @return      Vector of integration point weights    
     def get_integration_scheme ( self, name, npts ):
         xis, ws = self.__parent.get_integration_scheme( name, npts )
+        if self.__mesh is not None and self.__mesh.has_geometry_cache():
+            return xis, self.__mesh.get_geometry( name, npts )['weights'][self.__index]
         ws = np.array([w*np.abs(np.linalg.det(self.__get_jacobian( xi ))) for xi, w in zip(xis,ws)])
         return xis, ws
         
@@ -177,6 +302,11 @@ class Element:
     #  @param  xi Local coordinate vector
     #  @return    Matrix of shape function gradients
     def get_shapes_gradient ( self, xi ):
+        if self.__mesh is not None:
+            cached = self.__mesh.find_geometry( xi )
+            if cached is not None:
+                geom, ipoint = cached
+                return geom['gradients'][self.__index,ipoint]
         J_inv = np.linalg.inv( self.__get_jacobian( xi ) )
         std_shapes_grad = self.__parent.get_shapes_gradient(xi)
         return std_shapes_grad.dot( J_inv )
@@ -188,25 +318,116 @@ class Element:
         coords          = self.get_coordinates()
         std_shapes_grad = self.__parent.get_shapes_gradient(xi)
         return coords.T.dot( std_shapes_grad )
+
+    ## Get the list of nodes
+    def __get_nodes ( self ):
+        if self.__mesh is None:
+            return self.__nodes
+        return [self.__mesh.get_dof_node( dof ) for dof in self.get_dofs()]
     
 
+## Lookup table from IDs to indices
+#
+#  A dense index array is used when the IDs are compact non-negative
+#  integers, a dictionary otherwise.
+class IndexMap:
+
+    ## Constructor
+    #  @param IDs  Vector (int) of unique IDs, the index of an ID is its position
+    #  @param name Name of the IDs used in error messages
+    def __init__ ( self, IDs, name='ID' ):
+        IDs = np.asarray( IDs, dtype=int )
+        self.__name = name
+        self.__size = len(IDs)
+        if len(IDs)==0 or ( IDs.min() >= 0 and IDs.max() < 2*len(IDs)+16 ):
+            self.__dense = np.full( IDs.max()+1 if len(IDs) else 0, -1, dtype=int )
+            self.__dense[IDs] = np.arange( len(IDs) )
+            self.__dict  = None
+        else:
+            self.__dense = None
+            self.__dict  = { ID : index for index, ID in enumerate( IDs.tolist() ) }
+
+    ## Length function
+    def __len__ ( self ):
+        return self.__size
+
+    ## Get item function
+    #  @param  ID ID to look up
+    #  @return    Index of the ID
+    def __getitem__ ( self, ID ):
+        if self.__dense is not None:
+            index = self.__dense[ID] if 0 <= ID < len(self.__dense) else -1
+        else:
+            index = self.__dict.get( ID, -1 )
+        if index < 0:
+            raise RuntimeError( '%s %d not found' % ( self.__name, ID ) )
+        return int(index)
+
+    ## Look up an array of IDs
+    #  @param  IDs Array (int) of IDs to look up
+    #  @return     Array (int) of indices with the same shape
+    def lookup ( self, IDs ):
+        IDs = np.asarray( IDs, dtype=int )
+        if self.__dense is not None:
+            inrange = ( IDs >= 0 ) & ( IDs < len(self.__dense) )
+            indices = np.where( inrange, self.__dense[np.where( inrange, IDs, 0 )], -1 )
+        else:
+            indices = np.array( [ self.__dict.get( ID, -1 ) for ID in IDs.ravel().tolist() ], dtype=int ).reshape( IDs.shape )
+        if ( indices < 0 ).any():
+            raise RuntimeError( '%s %d not found' % ( self.__name, IDs[indices < 0][0] ) )
+        return indices
+
 ## Finite element mesh
+#
+#  The mesh stores the nodal coordinates and the element connectivity as
+#  arrays. The Dof index of a node is its row in the coordinate array. Node
+#  and Element objects are created on demand as views on these arrays.
 class Mesh:
 
     ## Constructor
-    #  @param nodes list of finite element nodes
-    #  @param elems list of finite elements
-    def __init__ ( self, nodes, elems ):
-       self.__nodes = nodes
-       self.__elems = elems
+    #  @param coords       Matrix (nnodes,2) of nodal coordinates
+    #  @param connectivity Matrix (int) (nelems,nnodes) of element Dof indices
+    #  @param parent       Standard/parent element of all elements
+    #  @param nodeIDs      Vector (int) of node IDs (default: Dof indices)
+    #  @param elemIDs      Vector (int) of element IDs (default: element indices)
+    #  @param refinement   Origin of the nodes in a coarser mesh (see get_refinement)
+    def __init__ ( self, coords, connectivity, parent, nodeIDs=None, elemIDs=None, refinement=None ):
+       assert coords.ndim==2 and coords.dtype==float
+       assert connectivity.ndim==2 and connectivity.shape[1]==len(parent)
+       self.__parent       = parent
+       self.__refinement   = refinement
+       self.__elemIDs      = np.arange( len(connectivity) ) if elemIDs is None else elemIDs
+       self.__geometry     = None
+       self.__set_nodes( coords, connectivity, np.arange( len(coords) ) if nodeIDs is None else nodeIDs )
+       self.__permutation  = np.arange( len(coords) )
+
+    ## Set the node arrays and reset the derived data
+    #  @param coords       Matrix (nnodes,2) of nodal coordinates
+    #  @param connectivity Matrix (int) (nelems,nnodes) of element Dof indices
+    #  @param nodeIDs      Vector (int) of node IDs
+    def __set_nodes ( self, coords, connectivity, nodeIDs ):
+       self.__coords       = coords
+       self.__connectivity = connectivity
+       self.__nodeIDs      = nodeIDs
+       self.__pattern      = None
+       self.__node_index   = None
+       self.__boundary     = None
+       if self.__geometry is not None:
+           self.__geometry.clear()
+
+       #Read-only views returned by the array getters
+       self.__coords_view = coords.view()
+       self.__coords_view.flags.writeable = False
+       self.__connectivity_view = connectivity.view()
+       self.__connectivity_view.flags.writeable = False
 
     ## Iterator function    
     def __iter__ ( self ):
-        return iter(self.__elems)        
+        return ( self.get_element( index ) for index in range( len(self) ) )
         
     ## Length function    
     def __len__ ( self ):
-        return len(self.__elems)
+        return len(self.__connectivity)
 
     ## String function
     def __str__ ( self ):
@@ -217,24 +438,627 @@ class Mesh:
     ## Get a node
     #  @param ID Node ID
     def get_node ( self, ID ):
-        for node in self.__nodes:
-            if node.get_ID()==ID:
-                return node
-        raise RuntimeError( 'Node ID %d not found' % ID )
+        return self.get_dof_node( self.get_node_index()[ID] )
+
+    ## Get the Dof indices of nodes
+    #  @param  IDs Array (int) of node IDs
+    #  @return     Array (int) of Dof indices with the same shape
+    def get_dofs ( self, IDs ):
+        return self.get_node_index().lookup( IDs )
+
+    ## Get the lookup table from node IDs to Dof indices
+    #
+    #  The table is built on the first call and kept for the lifetime of the mesh
+    def get_node_index ( self ):
+        if self.__node_index is None:
+            self.__node_index = IndexMap( self.__nodeIDs, 'Node ID' )
+        return self.__node_index
+
+    ## Get the node with a Dof index
+    #  @param dof Dof index
+    def get_dof_node ( self, dof ):
+        return Node( int(self.__nodeIDs[dof]), None, int(dof), self )
+
+    ## Get an element
+    #  @param index Element index
+    def get_element ( self, index ):
+        return Element( int(self.__elemIDs[index]), self.__parent, None, self, index )
     
     ## Get all nodal coordinates
     #  @return Matrix of nodal coordinates
     def get_nodal_coordinates ( self ):
-        return np.array([node.get_coordinate() for node in self.__nodes])
+        return self.__coords_view
+
+    ## Set the coordinate of a node
+    #  @param dof   Dof index
+    #  @param coord Node coordinate
+    def set_nodal_coordinate ( self, dof, coord ):
+        self.__coords[dof] = coord
+        self.__boundary = None
+        if self.__geometry is not None:
+            self.__geometry.clear()
     
     ## Get the element connectivity table
     #  @return Matrix (int) with element-Dof connectivities
     def get_connectivity ( self ):
-        return np.array([[node.get_dof() for node in elem] for elem in self],dtype=int)
+        return self.__connectivity_view
+
+    ## Get the node IDs
+    #  @return Vector (int) of node IDs, ordered by Dof index
+    def get_node_IDs ( self ):
+        return self.__nodeIDs
+
+    ## Renumber the degrees of freedom
+    #
+    #  The nodal arrays are permuted such that the Dof index of a node remains
+    #  its row in the coordinate array. Node IDs are permuted along, so results
+    #  can still be mapped to the original node IDs.
+    #
+    #  @param  method Ordering method: 'rcm' (reverse Cuthill-McKee, reduces
+    #                 the bandwidth) or None (keep the current numbering)
+    #  @return        Vector (int) with the old Dof index of every new Dof index
+    def renumber ( self, method='rcm' ):
+        if method is None:
+            return np.arange( self.get_nr_of_nodes() )
+        elif method=='rcm':
+            pattern = self.get_sparsity_pattern()
+            graph = pattern.to_csr( np.ones( pattern.get_nnz() ) )
+            perm  = np.asarray( reverse_cuthill_mckee( graph, symmetric_mode=True ), dtype=int )
+        else:
+            raise RuntimeError( 'Unknown renumbering method %s' % method )
+        inverse = np.empty_like( perm )
+        inverse[perm] = np.arange( len(perm) )
+        self.__set_nodes( self.__coords[perm], inverse[self.__connectivity], self.__nodeIDs[perm] )
+        self.__permutation = self.__permutation[perm]
+        if self.__refinement is not None:
+            self.__refinement = dict( self.__refinement, elements=self.__refinement['elements'][perm], xi=self.__refinement['xi'][perm] )
+        return perm
+
+    ## Get the permutation with respect to the original numbering
+    #  @return Vector (int) with the original Dof index of every Dof index
+    def get_permutation ( self ):
+        return self.__permutation
+
+    ## Refine the mesh uniformly
+    #
+    #  Every triangle is split into four triangles through its edge midpoints.
+    #  Linear meshes are lifted to quadratic elements and split into the
+    #  linear sub-triangles, quadratic meshes are split into their linear
+    #  sub-triangles and lifted again. New nodes are placed with the shape
+    #  functions of the coarse element, such that curved quadratic edges stay
+    #  curved. New nodes on a boundary edge between two constrained nodes are
+    #  constrained.
+    #
+    #  @param  cons    Indices of constrained Dofs
+    #  @param  project Function mapping a matrix (n,2) of coordinates of new
+    #                  boundary nodes onto the exact boundary (optional)
+    #  @return         Refined mesh (see get_refinement for the node origins)
+    #  @return         Indices of constrained Dofs of the refined mesh
+    def refine ( self, cons, project=None ):
+        sub = StandardTriangleP2().get_subtriangles()
+        if len(self.__parent)==3:
+            C, edges, boundary = lift_connectivity( self.__connectivity, self.__parent, self.get_nr_of_nodes() )
+            C = C[:,sub].reshape( -1, 3 )
+            parent = StandardTriangle()
+        else:
+            C = self.__connectivity[:,sub].reshape( -1, 3 )
+            C, edges, boundary = lift_connectivity( C, StandardTriangle(), self.get_nr_of_nodes() )
+            parent = self.__parent
+
+        #Local coordinates of the corners of every fine element in its coarse element
+        origin  = np.repeat( np.arange( len(self) ), len(sub) )
+        corners = np.tile( StandardTriangleP2().get_local_coordinates()[sub], ( len(self), 1, 1 ) )
+        return self.__create_refined( C, parent, origin, corners, edges, boundary, cons, project )
+
+    ## Refine marked elements by longest-edge bisection
+    #
+    #  The longest edge of every marked element is bisected. To keep the mesh
+    #  conforming, the longest edge of every element with a bisected edge is
+    #  bisected as well, until no edges are added. Every element is then split
+    #  through the midpoint of its longest edge and the midpoints of its other
+    #  bisected edges into two, three or four triangles (see bisection_patterns).
+    #  Quadratic elements are split through their midside nodes and get new
+    #  midside nodes on the new edges. New nodes are placed and constrained as
+    #  in refine.
+    #
+    #  @param  marked  Indices of the elements to refine
+    #  @param  cons    Indices of constrained Dofs
+    #  @param  project Function mapping a matrix (n,2) of coordinates of new
+    #                  boundary nodes onto the exact boundary (optional)
+    #  @return         Refined mesh (see get_refinement for the node origins)
+    #  @return         Indices of constrained Dofs of the refined mesh
+    def bisect ( self, marked, cons, project=None ):
+        nnodes  = self.get_nr_of_nodes()
+        nelems  = len(self)
+        local   = self.__parent.get_edges()
+        linear  = StandardTriangle()
+        C = self.__connectivity
+        V = C[:,local[:,0]]
+        E = V[:,linear.get_edges()]
+
+        #Number the edges and select the longest edge of every element
+        first, last = np.minimum( E[...,0], E[...,1] ), np.maximum( E[...,0], E[...,1] )
+        keys, index, edge_ids = np.unique( first*nnodes+last, return_index=True, return_inverse=True )
+        edge_ids = edge_ids.reshape( nelems, 3 )
+        lengths  = np.linalg.norm( self.__coords[E[...,1]] - self.__coords[E[...,0]], axis=2 )
+        longest  = np.argmax( lengths, axis=1 )
+        rows     = np.arange( nelems )
+
+        #Mark the longest edges, closing the marking for conformity
+        split = np.zeros( len(keys), dtype=bool )
+        split[edge_ids[marked,longest[marked]]] = True
+        while True:
+            closure = split[edge_ids].any( axis=1 ) & ~split[edge_ids[rows,longest]]
+            if not closure.any():
+                break
+            split[edge_ids[closure,longest[closure]]] = True
+
+        #Rotate the local vertices such that the longest edge is the first edge
+        rot = ( longest[:,np.newaxis] + np.arange( 3 ) ) % 3
+        rot_split = split[edge_ids[rows[:,np.newaxis],rot]]
+        points = np.zeros( (nelems,6), dtype=int )
+        points[:,:3] = V[rows[:,np.newaxis],rot]
+        xis = np.zeros( (nelems,6,2) )
+        xis[:,:3] = linear.get_local_coordinates()[rot]
+        xis[:,3:] = 0.5 * ( xis[:,:3] + xis[:,[1,2,0]] )
+
+        #Midpoints: the midside nodes of quadratic elements, or new nodes on the
+        #bisected edges of linear elements
+        if len(self.__parent)==6:
+            points[:,3:] = C[:,local[:,1]][rows[:,np.newaxis],rot]
+        else:
+            new = np.full( len(keys), -1 )
+            new[split] = nnodes + np.arange( split.sum() )
+            points[:,3:] = new[edge_ids[rows[:,np.newaxis],rot]]
+
+        #Split the elements by pattern, keeping the children of an element together
+        children, origin, corners = [], [], []
+        pattern_ids = np.where( rot_split[:,0], 1 + rot_split[:,1] + 2*rot_split[:,2], 0 )
+        for pid, pattern in enumerate( bisection_patterns ):
+            sel = np.flatnonzero( pattern_ids==pid )
+            children.append( points[sel][:,pattern] )
+            corners.append( xis[sel][:,pattern] )
+            origin.append( np.repeat( sel[:,np.newaxis], len(pattern), axis=1 ) )
+        origin   = np.concatenate( [ o.ravel() for o in origin ] )
+        order    = np.argsort( origin, kind='stable' )
+        origin   = origin[order]
+        children = np.concatenate( [ c.reshape( -1, 3 ) for c in children ] )[order]
+        corners  = np.concatenate( [ c.reshape( -1, 3, 2 ) for c in corners ] )[order]
+
+        if len(self.__parent)==6:
+            C, edges, boundary = lift_connectivity( children, linear, nnodes, self.__split_midside( children ) )
+            return self.__create_refined( C, self.__parent, origin, corners, edges, boundary, cons, project )
+
+        edge_nodes = np.column_stack( ( first.ravel()[index[split]], last.ravel()[index[split]] ) )
+        counts = np.bincount( edge_ids.ravel(), minlength=len(keys) )
+        return self.__create_refined( children, linear, origin, corners, edge_nodes, counts[split]==1, cons, project )
+
+    ## Find the existing midside nodes of the edges of bisected quadratic elements
+    #  @param  children Matrix (int) (nchildren,3) of vertex Dofs of the child elements
+    #  @return          Matrix (int) (nchildren,3) with the midside node of every
+    #                   child edge that is an edge of this mesh, or -1
+    def __split_midside ( self, children ):
+        nnodes = self.get_nr_of_nodes()
+        local  = self.__parent.get_edges()
+        E = self.__connectivity[:,local].reshape( -1, 3 )
+        keys, index = np.unique( np.minimum( E[:,0], E[:,2] )*nnodes + np.maximum( E[:,0], E[:,2] ), return_index=True )
+
+        CE = children[:,StandardTriangle().get_edges()]
+        child_keys = np.minimum( CE[...,0], CE[...,1] )*nnodes + np.maximum( CE[...,0], CE[...,1] )
+        pos = np.minimum( np.searchsorted( keys, child_keys ), len(keys)-1 )
+        return np.where( keys[pos]==child_keys, E[index[pos],1], -1 )
+
+    ## Lift a linear mesh to quadratic elements
+    #
+    #  A midside node is inserted on every edge. The elements are not split.
+    #
+    #  @param  cons    Indices of constrained Dofs
+    #  @param  project Function mapping a matrix (n,2) of coordinates of new
+    #                  boundary nodes onto the exact boundary (optional)
+    #  @return         Quadratic mesh (see get_refinement for the node origins)
+    #  @return         Indices of constrained Dofs of the quadratic mesh
+    def lift ( self, cons, project=None ):
+        if len(self.__parent)!=3:
+            raise RuntimeError( 'Only linear meshes can be lifted' )
+        C, edges, boundary = lift_connectivity( self.__connectivity, self.__parent, self.get_nr_of_nodes() )
+        origin  = np.arange( len(self) )
+        corners = np.tile( self.__parent.get_local_coordinates(), ( len(self), 1, 1 ) )
+        return self.__create_refined( C, StandardTriangleP2(), origin, corners, edges, boundary, cons, project )
+
+    ## Create a mesh with new edge nodes from this mesh
+    #  @param  connectivity Matrix (int) (nelems,nnodes) of Dof indices of the new mesh
+    #  @param  parent       Standard/parent element of the new mesh
+    #  @param  origin       Vector (int) with the element of every new element in this mesh
+    #  @param  corners      Array (nelems,3,2) of local coordinates of the corners of
+    #                       every new element in its element in this mesh
+    #  @param  edges        Matrix (int) (nnew,2) of the edge end Dofs of every new node
+    #  @param  boundary     Vector (bool) marking the new nodes on a boundary edge
+    #  @param  cons         Indices of constrained Dofs of this mesh
+    #  @param  project      Function mapping boundary coordinates onto the exact boundary
+    #  @return              New mesh
+    #  @return              Indices of constrained Dofs of the new mesh
+    def __create_refined ( self, connectivity, parent, origin, corners, edges, boundary, cons, project ):
+        nnodes = self.get_nr_of_nodes()
+        nfine  = nnodes + len(edges)
+
+        #Local coordinates of every node in a coarse element
+        local = parent.get_local_coordinates()
+        xi    = corners[:,np.newaxis,0] + local[np.newaxis,:,0,np.newaxis] * ( corners[:,np.newaxis,1] - corners[:,np.newaxis,0] ) \
+                                        + local[np.newaxis,:,1,np.newaxis] * ( corners[:,np.newaxis,2] - corners[:,np.newaxis,0] )
+        elements = np.empty( nfine, dtype=int )
+        elements[connectivity] = origin[:,np.newaxis]
+        node_xi = np.empty( (nfine,2) )
+        node_xi[connectivity] = xi
+
+        #Coordinates through the coarse element shape functions
+        N = self.__parent.get_shapes( node_xi.T ).T
+        coords = np.einsum( 'ni,nid->nd', N, self.__coords[self.__connectivity[elements]] )
+        coords[:nnodes] = self.__coords
+
+        constrained = np.zeros( nnodes, dtype=bool )
+        constrained[cons] = True
+        new_cons = nnodes + np.flatnonzero( boundary & constrained[edges[:,0]] & constrained[edges[:,1]] )
+        if project is not None:
+            new_boundary = nnodes + np.flatnonzero( boundary )
+            coords[new_boundary] = project( coords[new_boundary] )
+
+        nodeIDs = np.concatenate( ( self.__nodeIDs, self.__nodeIDs.max() + 1 + np.arange( len(edges) ) ) )
+        refinement = { 'coarse' : self, 'elements' : elements, 'xi' : node_xi }
+        mesh = Mesh( coords, connectivity, parent, nodeIDs, refinement=refinement )
+        return mesh, np.concatenate( ( np.asarray( cons, dtype=int ), new_cons ) )
+
+    ## Get the origin of the nodes in the coarser mesh this mesh was created from
+    #  @return Dictionary with the 'coarse' mesh, 'elements' (nnodes,) with a
+    #          coarse element index per node and 'xi' (nnodes,2) with the local
+    #          coordinates of every node in that element, or None if the mesh
+    #          was not created by refine or lift
+    def get_refinement ( self ):
+        return self.__refinement
+
+    ## Get the prolongation from the coarser mesh this mesh was created from
+    #
+    #  Every row interpolates a coarse solution in a node of this mesh with
+    #  the shape functions of its coarse element (see get_refinement).
+    #
+    #  @return Sparse matrix (nnodes,ncoarsenodes) (CSR)
+    def get_prolongation ( self ):
+        if self.__refinement is None:
+            raise RuntimeError( 'The mesh was not created from a coarser mesh' )
+        coarse = self.__refinement['coarse']
+        N = coarse.get_parent().get_shapes( self.__refinement['xi'].T ).T
+        N[np.abs( N ) < 1e-12] = 0.
+        rows = np.repeat( np.arange( self.get_nr_of_nodes() ), N.shape[1] )
+        cols = coarse.get_connectivity()[self.__refinement['elements']].ravel()
+        P = scipy.sparse.csr_matrix( ( N.ravel(), ( rows, cols ) ), shape=( self.get_nr_of_nodes(), coarse.get_nr_of_nodes() ) )
+        P.eliminate_zeros()
+        return P
+
+    ## Get the element IDs
+    #  @return Vector (int) of element IDs
+    def get_element_IDs ( self ):
+        return self.__elemIDs
         
     ## Get the number of nodes      
     def get_nr_of_nodes ( self ):
-        return len(self.__nodes)
+        return len(self.__coords)
+
+    ## Get the sparsity pattern of the element connectivity
+    #
+    #  The pattern is built on the first call and kept for the lifetime of the mesh
+    #  @return SparsityPattern with CSR structure and element scatter map
+    def get_sparsity_pattern ( self ):
+        if self.__pattern is None:
+            self.__pattern = SparsityPattern( self.get_nr_of_nodes(), self.get_connectivity() )
+        return self.__pattern
+
+    ## Get the boundary edges
+    #
+    #  The edges are built on the first call and kept until the mesh changes
+    #  @return Dictionary of boundary edge arrays (see calculate_boundary_edges)
+    def get_boundary_edges ( self ):
+        if self.__boundary is None:
+            self.__boundary = calculate_boundary_edges( self.get_nodal_coordinates(), self.__connectivity, self.__parent )
+        return self.__boundary
+
+    ## Select the boundary edges with constrained end nodes (the wall)
+    #  @param  cons Indices of constrained degrees of freedom
+    #  @return      Boolean vector that selects the constrained boundary edges
+    def get_constrained_edges ( self, cons ):
+        return np.isin( self.get_boundary_edges()['ends'], cons ).all( axis=1 )
+
+    ## Get the standard/parent element shared by all elements
+    def get_parent ( self ):
+        return self.__parent
+
+    ## Enable or disable the geometry cache
+    #
+    #  When enabled, the element geometry of every integration scheme is
+    #  computed once and reused by get_geometry and by the Element views,
+    #  until a nodal coordinate is changed.
+    #
+    #  @param enable Enable (True) or disable (False) the cache
+    def enable_geometry_cache ( self, enable=True ):
+        self.__geometry = {} if enable else None
+
+    ## Check if the geometry cache is enabled
+    def has_geometry_cache ( self ):
+        return self.__geometry is not None
+
+    ## Get the geometry of all elements in the integration points
+    #  @param  name The type of integration scheme (e.g. 'gauss')
+    #  @param  npts The number of integration points
+    #  @return      Dictionary of stacked geometry arrays (see calculate_geometry)
+    def get_geometry ( self, name, npts ):
+        if self.__geometry is not None and (name,npts) in self.__geometry:
+            return self.__geometry[ (name,npts) ]
+        X = self.get_nodal_coordinates()
+        C = self.get_connectivity()
+        geom = calculate_geometry( X[C], self.__parent, name, npts )
+        if self.__geometry is not None:
+            self.__geometry[ (name,npts) ] = geom
+        return geom
+
+    ## Find the cached geometry of an integration point
+    #  @param  xi Local coordinate vector
+    #  @return    Dictionary of cached geometry arrays and the integration
+    #             point index, or None if xi is not a cached integration point
+    def find_geometry ( self, xi ):
+        if not self.__geometry:
+            return None
+        for key, geom in self.__geometry.items():
+            xis, ws = self.__parent.get_integration_scheme( *key )
+            ipoints = np.flatnonzero( (xis==xi).all( axis=1 ) )
+            if len(ipoints) > 0:
+                return geom, ipoints[0]
+        return None
+
+## Calculate the geometry of a batch of elements
+#
+#  The Jacobians are evaluated with explicit 2x2 formulas, such that the
+#  result of every element does not depend on the size of the batch.
+#
+#  @param  coords Array (nelems,nnodes,2) of element nodal coordinates
+#  @param  parent Standard/parent element
+#  @param  name   The type of integration scheme (e.g. 'gauss')
+#  @param  npts   The number of integration points
+#  @return        Dictionary with the arrays 'jacobian' (nelems,npts,2,2),
+#                 'inverse' (nelems,npts,2,2), 'determinant' (nelems,npts),
+#                 'weights' (nelems,npts), 'shapes' (npts,nnodes) and
+#                 'gradients' (nelems,npts,nnodes,2)
+def calculate_geometry ( coords, parent, name, npts ):
+    xis, ws = parent.get_integration_scheme( name, npts )
+    N, dN = parent.get_shapes_table( name, npts )
+
+    #Jacobians J[e,q,a,b] = sum_n coords[e,n,a] * dN[q,n,b]
+    J = np.zeros( (len(coords),len(xis),2,2) )
+    for n in range( dN.shape[1] ):
+        J += coords[:,np.newaxis,n,:,np.newaxis] * dN[np.newaxis,:,n,np.newaxis,:]
+
+    det = J[...,0,0]*J[...,1,1] - J[...,0,1]*J[...,1,0]
+
+    J_inv = np.empty_like( J )
+    J_inv[...,0,0] =  J[...,1,1] / det
+    J_inv[...,0,1] = -J[...,0,1] / det
+    J_inv[...,1,0] = -J[...,1,0] / det
+    J_inv[...,1,1] =  J[...,0,0] / det
+
+    #Physical gradients G[e,q,n,b] = sum_a dN[q,n,a] * J_inv[e,q,a,b]
+    G = dN[np.newaxis,:,:,0,np.newaxis] * J_inv[:,:,np.newaxis,0,:] \
+      + dN[np.newaxis,:,:,1,np.newaxis] * J_inv[:,:,np.newaxis,1,:]
+
+    return { 'jacobian'    : J,
+             'inverse'     : J_inv,
+             'determinant' : det,
+             'weights'     : ws * np.abs(det),
+             'shapes'      : N,
+             'gradients'   : G }
+
+## Find the boundary edges of a mesh
+#
+#  Boundary edges are the element edges that belong to a single element.
+#
+#  @param  connectivity Matrix (int) (nelems,nnodes) of element Dof indices
+#  @param  parent       Standard/parent element
+#  @return              Matrix (int) (nedges,nedgenodes) of boundary edge Dofs
+#  @return              Vector (int) of the element index of every boundary edge
+def find_boundary_edges ( connectivity, parent ):
+    local = parent.get_edges()
+    edges = connectivity[:,local].reshape( -1, local.shape[1] )
+    first, last = np.minimum( edges[:,0], edges[:,-1] ), np.maximum( edges[:,0], edges[:,-1] )
+    keys, index, counts = np.unique( first*(connectivity.max()+1)+last, return_index=True, return_counts=True )
+    boundary = np.sort( index[counts==1] )
+    return edges[boundary], boundary // len(local)
+
+## Insert midside nodes in the edges of a linear mesh
+#
+#  Edges shared by two elements are identified through a hash of their end
+#  Dofs and get a single new node. The new nodes are numbered after the
+#  existing nodes in the order of their edge hash.
+#
+#  @param  connectivity Matrix (int) (nelems,3) of element Dof indices
+#  @param  parent       Linear standard/parent element
+#  @param  nnodes       Number of nodes
+#  @param  existing     Matrix (int) (nelems,3) with an existing midside node
+#                       per element edge, or -1 for a new node (optional)
+#  @return              Matrix (int) (nelems,6) of quadratic element Dof indices
+#  @return              Matrix (int) (nnew,2) of the edge end Dofs of every new node
+#  @return              Vector (bool) marking the new nodes on a boundary edge
+def lift_connectivity ( connectivity, parent, nnodes, existing=None ):
+    edges = connectivity[:,parent.get_edges()].reshape( -1, 2 )
+    first, last = np.minimum( edges[:,0], edges[:,1] ), np.maximum( edges[:,0], edges[:,1] )
+    mid = np.full( len(edges), -1 ) if existing is None else existing.ravel().copy()
+    new = mid < 0
+    keys, index, inverse, counts = np.unique( first[new]*nnodes+last[new], return_index=True, return_inverse=True, return_counts=True )
+    mid[new] = nnodes + inverse
+    mid = mid.reshape( -1, 3 )
+    lifted = np.column_stack( ( connectivity[:,0], mid[:,0], connectivity[:,1], mid[:,2], mid[:,1], connectivity[:,2] ) )
+    return lifted, np.column_stack( ( first[new][index], last[new][index] ) ), counts==1
+
+## Local point indices of the children of an element in longest-edge bisection
+#
+#  The points are the vertices v0, v1, v2 and the edge midpoints m01, m12,
+#  m20, with the longest edge from v0 to v1. The patterns are ordered by the
+#  bisected edges: none, the longest edge only, and the longest edge with
+#  edge v1-v2, with edge v2-v0 or with both.
+bisection_patterns = ( [[0,1,2]],
+                       [[0,3,2],[3,1,2]],
+                       [[0,3,2],[3,1,4],[3,4,2]],
+                       [[0,3,5],[5,3,2],[3,1,2]],
+                       [[0,3,5],[5,3,2],[3,1,4],[3,4,2]] )
+
+## Calculate the boundary edges of a mesh
+#
+#  The edges are ordered along the boundary in counter-clockwise direction,
+#  such that the outward normal is the chord direction rotated clockwise.
+#
+#  @param  X            Matrix of nodal coordinates
+#  @param  connectivity Matrix (int) (nelems,nnodes) of element Dof indices
+#  @param  parent       Standard/parent element
+#  @return              Dictionary with the arrays 'nodes' (nedges,nedgenodes)
+#                       of edge Dofs, 'ends' (nedges,2) of end node Dofs,
+#                       'midside' (nedges,) of midside node Dofs (None for
+#                       linear elements), 'elements' (nedges,) of element
+#                       indices, 'normals' (nedges,2) of outward unit normals
+#                       and 'lengths' (nedges,) of edge lengths
+@profiled( 'boundary' )
+def calculate_boundary_edges ( X, connectivity, parent ):
+    edges, elems = find_boundary_edges( connectivity, parent )
+
+    #Reverse the edges of clockwise oriented elements
+    corners = X[connectivity[elems][:,parent.get_edges()[:,0]]]
+    a, b = corners[:,1] - corners[:,0], corners[:,2] - corners[:,0]
+    edges = np.where( ( a[:,0]*b[:,1] - a[:,1]*b[:,0] < 0 )[:,np.newaxis], edges[:,::-1], edges )
+
+    ends    = edges[:,[0,-1]]
+    chords  = X[ends[:,1]] - X[ends[:,0]]
+    normals = np.column_stack( ( chords[:,1], -chords[:,0] ) ) / np.linalg.norm( chords, axis=1 )[:,np.newaxis]
+
+    count( 'edges', len(edges) )
+    return { 'nodes'    : edges,
+             'ends'     : ends,
+             'midside'  : edges[:,1] if edges.shape[1]==3 else None,
+             'elements' : elems,
+             'normals'  : normals,
+             'lengths'  : calculate_edge_lengths( X, edges ) }
+
+## Calculate the area enclosed by boundary edges
+#
+#  Uses the divergence theorem on the straight segments between consecutive
+#  edge nodes: A = 1/2 sum x_mid . n l
+#
+#  @param  X     Matrix of nodal coordinates
+#  @param  edges Matrix (int) (nedges,nedgenodes) of edge Dofs, ordered along
+#                the boundary in counter-clockwise direction
+#  @return       Enclosed area
+def calculate_enclosed_area ( X, edges ):
+    area = 0.
+    for i in range( edges.shape[1]-1 ):
+        x0, x1 = X[edges[:,i]], X[edges[:,i+1]]
+        area += 0.5 * ( (x0+x1)/2 * np.column_stack( ( x1[:,1]-x0[:,1], x0[:,0]-x1[:,0] ) ) ).sum()
+    return area
+
+## Calculate the lengths of (curved) edges
+#
+#  Two-node edges are straight, three-node edges are integrated along the
+#  quadratic parametric map with a 3-point Gauss rule.
+#
+#  @param  X     Matrix of nodal coordinates
+#  @param  edges Matrix (int) (nedges,nedgenodes) of edge Dofs
+#  @return       Vector of edge lengths
+def calculate_edge_lengths ( X, edges ):
+    if edges.shape[1]==2:
+        return np.linalg.norm( X[edges[:,1]] - X[edges[:,0]], axis=1 )
+    ts = 0.5 + 0.5*np.sqrt(0.6)*np.array([-1.,0.,1.])
+    ws = np.array([5.,8.,5.]) / 18.
+    lengths = np.zeros( len(edges) )
+    for t, w in zip( ts, ws ):
+        dxdt = (4*t-3)*X[edges[:,0]] + (4-8*t)*X[edges[:,1]] + (4*t-1)*X[edges[:,2]]
+        lengths += w * np.linalg.norm( dxdt, axis=1 )
+    return lengths
+
+## Calculate the flow properties of a pipe flow solution
+#
+#  Computes all quantities in a single pass over the mesh arrays: the area
+#  and flux are integrated with the element quadrature and the wetted
+#  perimeter is the length of the constrained boundary edges (the wall), as
+#  in calculate_circumference.
+#
+#  @param  mesh   Finite element mesh
+#  @param  sol    Solution vector
+#  @param  cons   Indices of constrained degrees of freedom
+#  @param  params Dictionary of model parameters
+#  @return        Dictionary with the 'area', 'flux', 'velocity' (average),
+#                 'perimeter' and 'geometry_factor'
+@profiled( 'postprocess' )
+def calculate_flow_properties ( mesh, sol, cons, params ):
+    C = mesh.get_connectivity()
+
+    geom  = mesh.get_geometry( 'gauss', 3 )
+    W     = geom['weights']
+    area  = W.sum()
+    flux  = ( W * sol[C].dot( geom['shapes'].T ) ).sum()
+    u     = flux / area
+
+    lc = mesh.get_boundary_edges()['lengths'][mesh.get_constrained_edges( cons )].sum()
+
+    mu    = params['viscosity']
+    s     = params['pressure_drop']/params['length']
+
+    return { 'area'            : area,
+             'flux'            : flux,
+             'velocity'        : u,
+             'perimeter'       : lc,
+             'geometry_factor' : (32/u)*((area/lc)**2)*(s/mu) }
+
+## Calculate the gradient recovery (ZZ) error indicators of a solution
+#
+#  The recovered gradient is the area-weighted average over the elements of
+#  the solution gradient at every node, interpolated with the element shape
+#  functions. The indicator of an element is the L2 norm of the difference
+#  between the recovered gradient and the solution gradient on the element.
+#
+#  @param  mesh Finite element mesh
+#  @param  sol  Solution vector
+#  @return      Vector (nelems,) of error indicators
+@profiled( 'estimate' )
+def calculate_error_indicators ( mesh, sol ):
+    X = mesh.get_nodal_coordinates()
+    C = mesh.get_connectivity()
+    parent = mesh.get_parent()
+    geom = mesh.get_geometry( 'gauss', 3 )
+    area = geom['weights'].sum( axis=1 )
+
+    #Average the element gradients in the nodes
+    recovered = np.zeros( (len(X),2) )
+    for a, xi in enumerate( parent.get_local_coordinates() ):
+        dN = parent.get_shapes_gradient( xi )
+        J  = np.einsum( 'enc,nd->ecd', X[C], dN )
+        det = J[:,0,0]*J[:,1,1] - J[:,0,1]*J[:,1,0]
+        J_inv = np.stack( ( np.stack( ( J[:,1,1], -J[:,0,1] ), axis=1 ),
+                            np.stack( ( -J[:,1,0], J[:,0,0] ), axis=1 ) ), axis=1 ) / det[:,np.newaxis,np.newaxis]
+        grad = np.einsum( 'en,nc,ecd->ed', sol[C], dN, J_inv )
+        for d in range( 2 ):
+            recovered[:,d] += np.bincount( C[:,a], weights=area*grad[:,d], minlength=len(X) )
+    recovered /= np.bincount( C.ravel(), weights=np.repeat( area, C.shape[1] ), minlength=len(X) )[:,np.newaxis]
+
+    #Integrate the difference with the element gradients
+    grad = np.einsum( 'en,eqnd->eqd', sol[C], geom['gradients'] )
+    diff = np.einsum( 'qn,end->eqd', geom['shapes'], recovered[C] ) - grad
+    return np.sqrt( ( geom['weights'] * ( diff**2 ).sum( axis=2 ) ).sum( axis=1 ) )
+
+## Mark elements for refinement with the bulk (Doerfler) criterion
+#
+#  Selects the smallest set of elements with the largest indicators whose
+#  squared indicators sum to at least a fraction of the total.
+#
+#  @param  indicators Vector of element error indicators
+#  @param  theta      Bulk fraction (0 < theta <= 1)
+#  @return            Indices of the marked elements
+def mark_elements ( indicators, theta=0.5 ):
+    assert 0. < theta <= 1.
+    order = np.argsort( -indicators, kind='stable' )
+    total = np.cumsum( indicators[order]**2 )
+    return np.sort( order[:np.searchsorted( total, theta*total[-1] )+1] )
 
 ## Calculate Cross Section
 def calculate_cross_section(mesh):
@@ -293,114 +1117,33 @@ def calculate_average_velocity_b(mesh, sol, cons):
     
 ## Determine Boundary Node Values
 def Boundary_Nodes(mesh, cons):
-    C = mesh.get_connectivity()
-    B = cons
-    
-    Boundary_Node=[]
-    for i in range(0, len(C)):
-        boolarr = np.in1d(C[i,:],B)
-        if np.sum(boolarr) > 1:
-            position = np.where(np.in1d(C[i,:],B))
-            place = position[0]
-            if np.sum(boolarr) == 2:
-                Boundary_Node.append([C.item(i,place[0]) , C.item(i,place[1])])
-            elif np.sum(boolarr) == 3:
-                Boundary_Node.append([C.item(i,place[0]) , C.item(i,place[1]), C.item(i,place[2])])
-    return Boundary_Node
+    return constrained_boundary_edges(mesh, cons).tolist()
+
+## Select the boundary edges with constrained end nodes
+def constrained_boundary_edges(mesh, cons):
+    return mesh.get_boundary_edges()['nodes'][mesh.get_constrained_edges(cons)]
 
 
 ## Calculate circumference
 def calculate_circumference(mesh, cons):
-    X = mesh.get_nodal_coordinates()
-    Z = np.array(Boundary_Nodes(mesh, cons))
-    
-    length = 0
-    for i in range(0, len(Z)):
-        if len(Z[0,:]) == 2: 
-            length_i = calculate_length(X, [Z[i,0], Z[i,1]])
-            length += length_i
-        elif len(Z[0,:]) == 3:
-            length_1 = calculate_length(X, [Z[i,0], Z[i,1]])
-            length_2 = calculate_length(X, [Z[i,1], Z[i,2]])
-            length_3 = calculate_length(X, [Z[i,0], Z[i,2]])
-            if length_1 > length_2 and length_1 > length_3:
-                length_i = length_2 + length_3
-                length += length_i
-            elif length_2 > length_1 and length_2 > length_3:
-                length_i = length_1 + length_3
-                length += length_i
-            elif length_3 > length_1 and length_3 > length_2:
-                length_i = length_1 + length_2
-                length += length_i
-    return length
-
-## Calculate length between two points
-def calculate_length(X, nodes):
-    length = math.sqrt(( X.item(nodes[0],0) - X.item(nodes[1],0))**2 + 
-                            ( X.item(nodes[0],1) - X.item(nodes[1],1))**2  )
-    return length
-
-## Calculate the normal vector on the element
-def calculate_normal(mesh, nodes):
-    X = mesh.get_nodal_coordinates()    
-
-    dx = X.item(nodes[0], 0) - X.item(nodes[1], 0)
-    dy = X.item(nodes[0], 1) - X.item(nodes[1], 1)
-    
-    norm = [-dy, dx]
-    return norm
-
+    return mesh.get_boundary_edges()['lengths'][mesh.get_constrained_edges(cons)].sum()
 
 ## Calculate the cross sectional area
-def cross_sectional_area(mesh, cons):
-    X = mesh.get_nodal_coordinates()
-    Z = np.array(Boundary_Nodes(mesh, cons))
-    Ac = 0
-    for i in range(0, len(Z)):
-        if len(Z[0,:]) == 2:
-            Ac_i = cross_sectional_area_section(mesh, [Z[i,0], Z[i,1]])
-            Ac += Ac_i
-        elif len(Z[0,:]) == 3:
-            length_1 = calculate_length(X, [Z[i,0], Z[i,1]])
-            length_2 = calculate_length(X, [Z[i,1], Z[i,2]])
-            length_3 = calculate_length(X, [Z[i,0], Z[i,2]])
-            if length_1 > length_2 and length_1 > length_3:
-                Ac_i = cross_sectional_area_section(mesh, [Z[i,1], Z[i,2]]) + cross_sectional_area_section(mesh, [Z[i,0], Z[i,2]])
-                Ac += Ac_i
-            elif length_2 > length_1 and length_2 > length_3:
-                Ac_i = cross_sectional_area_section(mesh, [Z[i,0], Z[i,1]]) + cross_sectional_area_section(mesh, [Z[i,0], Z[i,2]])
-                Ac += Ac_i
-            elif length_3 > length_1 and length_3 > length_2:
-                Ac_i = cross_sectional_area_section(mesh, [Z[i,0], Z[i,1]]) + cross_sectional_area_section(mesh, [Z[i,1], Z[i,2]])
-                Ac += Ac_i
-   
-    Ac = Ac/2
-    return Ac
-
-## Calculate cross sectional area of part of a quadratic element
-def cross_sectional_area_section(mesh, nodes):
+#
+#  The divergence theorem needs a closed curve, so all boundary edges are
+#  used: the constrained edges (the wall) are an open chain on meshes with
+#  symmetry boundaries. The constraints are not needed.
+def cross_sectional_area(mesh, cons=None):
     X = mesh.get_nodal_coordinates()
-    
-    norm = calculate_normal(mesh, [nodes[0], nodes[1]])
-    coor = (X[nodes[0], :] + X[nodes[1], :]) / 2
-    Ac = abs(np.dot(coor, norm))
-    return Ac
-    
+    return calculate_enclosed_area(X, mesh.get_boundary_edges()['nodes'])
+
      ## Geometry Factor
 def geometry_factor(mesh, sol, cons, params):
-    u_a = calculate_average_velocity_a(mesh, sol, cons)
-    u_b = calculate_average_velocity_b(mesh, sol, cons)
-    lc = calculate_circumference(mesh, cons)
-    Ac_a = calculate_cross_section(mesh)
-    Ac_b = cross_sectional_area(mesh, cons)
-
-    mu    = params['viscosity']
-    s     = params['pressure_drop']/params['length']
+    result = calculate_flow_properties(mesh, sol, cons, params)
 
-    gm = (32/u_b)*((Ac_b/lc)**2)*(s/mu)
+    print("cross-sec. area      [m^2] : ", result['area'])
+    print("velocity average     [m/s] : ", result['velocity'])
+    print("circumference        [m]   : ", result['perimeter'])
+    print("geometry factor      [-]   : ", result['geometry_factor'])
 
-    print("cross-sec. area old     [m^2] : ", Ac_a)
-    print("cross-sec. area new     [m^2] : ", Ac_b)
-    print("velocity average     [m/s] : ", u_b)
-    print("circumference        [m]   : ", lc)
-    print("geometry factor      [-]   : ", gm)
\ No newline at end of file
+    return result
@@ -1,112 +1,386 @@
 ## @package myIOlib
-#  This module contains a mesh reader and basic plotting function
+#  This module contains a mesh reader, a VTU writer and basic plotting functions
 
 from myFElib import *
 import numpy
+import os
+import json
+import hashlib
+import base64
+import sys
+from xml.sax.saxutils import quoteattr
+from myProfilelib import profiled, count, annotate
 ## Mesh file reader
 #
+#  The parsed arrays are stored in a compiled mesh file next to the text file
+#  (see compile_mesh), which is reused as long as the text file is unchanged.
+#
+#  @param  fname    Name of the mesh file
+#  @param  cache    Use (and create) the compiled mesh file
+#  @param  renumber Dof renumbering method applied after loading (see Mesh.renumber)
+#  @return          Finite element mesh
+#  @return          Indices of constrained degrees of freedom
+@profiled( 'read' )
+def read_from_txt ( fname, cache=True, renumber=None ):
+
+    if cache:
+        nodeIDs, coords, elemIDs, connectivity, cons = read_compiled( fname )
+    else:
+        nodeIDs, coords, elemIDs, connectivity, cons = parse_txt( fname )
+
+    #Create the mesh, the Dof index is the position in the file and the
+    #parent element follows from the number of nodes per element
+    mesh = Mesh( coords, connectivity, get_standard_element( connectivity.shape[1] ), nodeIDs, elemIDs )
+
+    #Renumber the Dofs, the constraints follow the permutation
+    if renumber is not None:
+        perm = mesh.renumber( renumber )
+        inverse = numpy.empty_like( perm )
+        inverse[perm] = numpy.arange( len(perm) )
+        cons = numpy.sort( inverse[cons] )
+
+    annotate( mesh=fname )
+    count( 'nodes', mesh.get_nr_of_nodes() )
+    count( 'elements', len(mesh) )
+    return mesh, cons
+
+## Parse a mesh file into arrays
+#
+#  The sections are converted in bulk and node IDs are mapped to Dof indices
+#  through an IndexMap, such that the parsing time is linear in the file size.
+#
 #  @param  fname Name of the mesh file
-#  @return       Finite element mesh
+#  @return       Vector (int) of node IDs
+#  @return       Matrix (nnodes,2) of nodal coordinates
+#  @return       Vector (int) of element IDs
+#  @return       Matrix (int) (nelems,nnodes) of element Dof indices
 #  @return       Indices of constrained degrees of freedom
-def read_from_txt ( fname ):
+def parse_txt ( fname ):
 
-    #Open the file to read
-    fin = open( fname )
-    
-    #Read the number of nodes
-    line     = fin.readline()
-    linelist = line.strip().split()
+    #Read the file, skipping empty lines
+    with open( fname ) as fin:
+        lines = [ line for line in fin.read().splitlines() if line.strip() ]
+
+    #Read the nodes
+    linelist = lines[0].split()
     assert linelist[0]=='NNODES'
     nnodes = int(linelist[1])
+    table   = parse_table( lines[1:1+nnodes], float )
+    nodeIDs = table[:,0].astype( int )
+    coords  = numpy.ascontiguousarray( table[:,1:] )
 
-    #Read the nodes
-    nodes   = []
-    nodeIDs = []
-    for dof in range( nnodes ):
-
-        linelist = fin.readline().strip().split()
-        nodeID   = int(linelist[0])
-        coord    = numpy.array(linelist[1:],dtype=float)
-        node     = Node( nodeID, coord, dof )
-        
-        nodeIDs.append( nodeID )
-        nodes  .append( node   )
-
-    #Empty line
-    fin.readline()
-
-    #Read the number of elements
-    linelist = fin.readline().strip().split()
+    #Read the elements
+    linelist = lines[1+nnodes].split()
     assert linelist[0]=='NELEMS'
     nelems = int(linelist[1])
-
-    #Read the elements
-    elems = []
-    std_triangle = StandardTriangle()
-    for ielem in range( nelems ):
-        
-        linelist    = fin.readline().strip().split()
-        elemID      = int(linelist[0])
-        elemnodeIDs = numpy.array(linelist[1:],dtype=int)
-        elemnodes   = [ nodes[nodeIDs.index(elemnodeID)] for elemnodeID in elemnodeIDs ]
-        elem        = Element( elemID, std_triangle, elemnodes )
-        
-        elems.append( elem )
-
-    mesh = Mesh( nodes, elems )
-
-    #Empty line
-    fin.readline()
+    table   = parse_table( lines[2+nnodes:2+nnodes+nelems], int )
+    elemIDs = table[:,0]
+    index   = IndexMap( nodeIDs, 'Node ID' )
+    connectivity = index.lookup( table[:,1:] )
 
     #Read the zero constraints
-    assert fin.readline().strip()=='ZEROCONS'        
-    linelist = fin.readline().strip().split()
-    nodeIDs  = numpy.array(linelist,dtype=int)        
-    dofs     = [ mesh.get_node( nodeID ).get_dof() for nodeID in nodeIDs ]
-    cons = numpy.array(dofs,dtype=int)
-    
-    fin.close()
-    
-    return mesh, cons
- 
+    assert lines[2+nnodes+nelems].strip()=='ZEROCONS'
+    consIDs = numpy.array( ' '.join( lines[3+nnodes+nelems:] ).split(), dtype=int )
+    cons    = index.lookup( consIDs )
+
+    return nodeIDs, coords, elemIDs, connectivity, cons
+
+## Names of the arrays in a compiled mesh file, in the order of parse_txt
+compiled_arrays = ( 'nodeIDs', 'coords', 'elemIDs', 'connectivity', 'cons' )
+
+## Identification string of a compiled mesh file
+compiled_magic = b'MYFEMESH'
+
+## Alignment (bytes) of the header and arrays in a compiled mesh file
+compiled_align = 64
+
+## Round up an offset to the alignment of a compiled mesh file
+#  @param  offset Offset in bytes
+#  @return        Aligned offset in bytes
+def align_offset ( offset ):
+    return -(-offset // compiled_align) * compiled_align
+
+## Get the name of the compiled mesh file belonging to a mesh file
+#  @param  fname Name of the mesh file
+#  @return       Name of the compiled mesh file
+def compiled_name ( fname ):
+    return os.path.splitext( fname )[0] + '.npmesh'
+
+## Read the mesh arrays through the compiled mesh file
+#
+#  The compiled file is (re)created when it is missing or invalid, or when
+#  both the modification time and the hash of the mesh file have changed.
+#
+#  @param  fname Name of the mesh file
+#  @return       Arrays as returned by parse_txt
+def read_compiled ( fname ):
+    cname = compiled_name( fname )
+    if os.path.exists( cname ):
+        arrays = load_compiled( cname, fname )
+        if arrays is not None:
+            count( 'compiled_hits' )
+            return arrays
+    arrays = parse_txt( fname )
+    try:
+        compile_mesh( cname, fname, arrays )
+    except OSError:
+        pass
+    return arrays
+
+## Get the identification of a mesh file
+#  @param  fname Name of the mesh file
+#  @param  hash  Include the SHA-1 hash of the contents
+#  @return       Dictionary with size, modification time and (optional) hash
+def source_stamp ( fname, hash=True ):
+    stat  = os.stat( fname )
+    stamp = { 'size' : stat.st_size, 'mtime' : stat.st_mtime_ns }
+    if hash:
+        with open( fname, 'rb' ) as fin:
+            stamp['sha1'] = hashlib.sha1( fin.read() ).hexdigest()
+    return stamp
+
+## Write a compiled mesh file
+#
+#  Layout: magic string, header length (uint64), JSON header and the raw
+#  arrays, each starting at an aligned offset. The file is written to a
+#  temporary name first, such that concurrent readers never see a partial file.
+#
+#  @param cname  Name of the compiled mesh file
+#  @param fname  Name of the mesh file it was compiled from
+#  @param arrays Arrays as returned by parse_txt
+def compile_mesh ( cname, fname, arrays ):
+    arrays = [ numpy.ascontiguousarray( array ) for array in arrays ]
+
+    #Determine the array offsets relative to the data section
+    entries = {}
+    offset  = 0
+    for name, array in zip( compiled_arrays, arrays ):
+        entries[name] = { 'dtype' : array.dtype.str, 'shape' : array.shape, 'offset' : offset }
+        offset = align_offset( offset + array.nbytes )
+
+    header = json.dumps( { 'source' : source_stamp( fname ), 'arrays' : entries } ).encode()
+    start  = align_offset( len(compiled_magic) + 8 + len(header) )
+
+    tmpname = '%s.%d.tmp' % ( cname, os.getpid() )
+    with open( tmpname, 'wb' ) as fout:
+        fout.write( compiled_magic )
+        fout.write( numpy.uint64( len(header) ).tobytes() )
+        fout.write( header )
+        for name, array in zip( compiled_arrays, arrays ):
+            fout.seek( start + entries[name]['offset'] )
+            fout.write( array.tobytes() )
+        fout.truncate( start + offset )
+    os.replace( tmpname, cname )
+
+## Load a compiled mesh file
+#
+#  The arrays are memory-mapped copy-on-write, such that processes reading
+#  the same mesh share the pages until they modify them. When the mesh file
+#  has a new modification time but the same contents, the compiled file is
+#  rewritten with the new stamp, such that later loads do not hash again.
+#
+#  @param  cname Name of the compiled mesh file
+#  @param  fname Name of the mesh file it was compiled from (optional)
+#  @return       Arrays as returned by parse_txt, or None if the compiled
+#                file is invalid or outdated
+def load_compiled ( cname, fname=None ):
+    try:
+        with open( cname, 'rb' ) as fin:
+            if fin.read( len(compiled_magic) ) != compiled_magic:
+                return None
+            length = int( numpy.frombuffer( fin.read( 8 ), dtype=numpy.uint64 )[0] )
+            header = json.loads( fin.read( length ).decode() )
+        start = align_offset( len(compiled_magic) + 8 + length )
+
+        refresh = False
+        if fname is not None:
+            stamp = header['source']
+            if source_stamp( fname, hash=False ) != { 'size' : stamp['size'], 'mtime' : stamp['mtime'] }:
+                if source_stamp( fname ) ['sha1'] != stamp['sha1']:
+                    return None
+                refresh = True
+
+        #Check that all arrays are inside the file
+        entries = [ header['arrays'][name] for name in compiled_arrays ]
+        end = max( entry['offset'] + int( numpy.prod( entry['shape'] ) ) * numpy.dtype( entry['dtype'] ).itemsize for entry in entries )
+        if os.path.getsize( cname ) < start + end:
+            return None
+
+        arrays = []
+        for entry in entries:
+            shape = tuple( entry['shape'] )
+            if numpy.prod( shape ) == 0:
+                arrays.append( numpy.zeros( shape, dtype=entry['dtype'] ) )
+            else:
+                arrays.append( numpy.memmap( cname, dtype=entry['dtype'], mode='c', offset=start+entry['offset'], shape=shape ) )
+    except ( ValueError, KeyError, TypeError, IndexError, OSError ):
+        return None
+
+    if refresh:
+        try:
+            compile_mesh( cname, fname, arrays )
+        except OSError:
+            pass
+    return tuple( arrays )
+
+## Convert lines with an equal number of columns to a matrix
+#  @param  lines List of lines
+#  @param  dtype Data type of the matrix
+#  @return       Matrix with a row per line
+def parse_table ( lines, dtype ):
+    ncols = len(lines[0].split()) if lines else 0
+    return numpy.array( ' '.join( lines ).split(), dtype=dtype ).reshape( len(lines), ncols )
+
+## VTK cell type and node order per number of element nodes
+#
+#  The quadratic triangle of VTK lists the corner nodes before the midside
+#  nodes, while StandardTriangleP2 orders the nodes row by row.
+vtk_cells = { 3 : ( 5,  [0,1,2] ),
+              6 : ( 22, [0,2,5,1,4,3] ) }
+
+## VTK names of the array data types
+vtk_types = { 'float64' : 'Float64', 'int64' : 'Int64', 'uint8' : 'UInt8' }
+
+## Write a mesh and solution fields to a VTK unstructured grid (.vtu) file
+#
+#  All arrays are stored in the appended data section, each block preceded
+#  by its length in bytes (UInt64). With the raw encoding the blocks are
+#  written directly from the array buffers. A field is a vector (nnodes,)
+#  or a matrix (nnodes,ncomps), a series of solutions (e.g. from
+#  PipeFlow.sweep) is written as one field per solution in a single file.
+#
+#  @param fname      Name of the output file
+#  @param mesh       Finite element mesh
+#  @param fields     Dictionary of nodal fields by name (optional)
+#  @param cellfields Dictionary of element fields by name (optional)
+#  @param encoding   Encoding of the appended data ('raw' or 'base64')
+def write_vtu ( fname, mesh, fields=None, cellfields=None, encoding='raw' ):
+    assert encoding in ( 'raw', 'base64' )
+    fields     = fields or {}
+    cellfields = cellfields or {}
+
+    X = mesh.get_nodal_coordinates()
+    C = mesh.get_connectivity()
+    celltype, order = vtk_cells[ C.shape[1] ]
+
+    points = numpy.zeros( ( len(X), 3 ) )
+    points[:,:2] = X
+
+    sections = { 'Points'    : [ ( 'Points', points ) ],
+                 'Cells'     : [ ( 'connectivity', C[:,order].astype( numpy.int64 ).ravel() ),
+                                 ( 'offsets', numpy.arange( 1, len(C)+1, dtype=numpy.int64 ) * C.shape[1] ),
+                                 ( 'types', numpy.full( len(C), celltype, dtype=numpy.uint8 ) ) ],
+                 'PointData' : [ ( name, numpy.asarray( field, dtype=float ) ) for name, field in fields.items() ],
+                 'CellData'  : [ ( name, numpy.asarray( field, dtype=float ) ) for name, field in cellfields.items() ] }
+
+    for name, array in sections['PointData']:
+        if len(array) != len(X):
+            raise RuntimeError( 'Field %s has %d instead of %d nodal values' % ( name, len(array), len(X) ) )
+    for name, array in sections['CellData']:
+        if len(array) != len(C):
+            raise RuntimeError( 'Field %s has %d instead of %d element values' % ( name, len(array), len(C) ) )
+
+    #Describe the arrays by their offset in the appended data section
+    lines  = [ '<?xml version="1.0"?>',
+               '<VTKFile type="UnstructuredGrid" version="1.0" byte_order="%s" header_type="UInt64">'
+               % ( 'LittleEndian' if sys.byteorder=='little' else 'BigEndian' ),
+               '<UnstructuredGrid>',
+               '<Piece NumberOfPoints="%d" NumberOfCells="%d">' % ( len(X), len(C) ) ]
+    blocks = []
+    offset = 0
+    for section, arrays in sections.items():
+        lines.append( '<%s>' % section )
+        for name, array in arrays:
+            array = numpy.ascontiguousarray( array )
+            lines.append( '<DataArray type="%s" Name=%s NumberOfComponents="%d" format="appended" offset="%d"/>'
+                          % ( vtk_types[array.dtype.name], quoteattr( name ), 1 if array.ndim==1 else array.shape[1], offset ) )
+            blocks.append( array )
+            nbytes  = 8 + array.nbytes
+            offset += nbytes if encoding=='raw' else 4 * ( ( nbytes + 2 ) // 3 )
+        lines.append( '</%s>' % section )
+    lines += [ '</Piece>', '</UnstructuredGrid>', '<AppendedData encoding="%s">' % encoding, '_' ]
+
+    with open( fname, 'wb' ) as fout:
+        fout.write( '\n'.join( lines ).encode() )
+        for array in blocks:
+            size = numpy.uint64( array.nbytes ).tobytes()
+            if encoding=='raw':
+                fout.write( size )
+                fout.write( memoryview( array ).cast( 'B' ) )
+            else:
+                fout.write( base64.b64encode( size + array.tobytes() ) )
+        fout.write( b'\n</AppendedData>\n</VTKFile>\n' )
 
-import matplotlib.pyplot as plt
-import matplotlib.tri as tri
 
 ## Plot the solution on a finite element mesh
 #
+#  Matplotlib is imported on the first call only, such that a run without
+#  plots imports nothing graphical. The figure is rendered with the Agg
+#  canvas directly instead of through pyplot, such that the backend and the
+#  open figures of an interactive session are left alone.
+#
+#  The default plot draws the element corner triangles with their edges. The
+#  fast plot splits every element in its linear sub-triangles (see
+#  StandardTriangle.get_subtriangles), such that quadratic elements show the
+#  midside values, and renders them as a single rasterized image without
+#  edge strokes.
+#
 #  @param mesh    Finite element mesh
 #  @param sol     Solution vector
 #  @param outfile Name of the output file
-def plot_solution( mesh, sol, outfile ):
+#  @param fast    Use the fast rasterized plot
+#  @param dpi     Resolution of the output file (default: matplotlib setting)
+def plot_solution( mesh, sol, outfile, fast=False, dpi=None ):
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import matplotlib.tri as tri
 
     #Create the Triangulation
     X = mesh.get_nodal_coordinates()
     C = mesh.get_connectivity()
-    D = numpy.zeros((len(C), 3)) ##TODO rename variable
-    
-    if len(C[0,:]) == 6:
-        for i in range( len(C) ):
-            D[i,:] = [C[i, 0], C[i, 2], C[i, 5]]
-    
-        triang = tri.Triangulation( X[:,0], X[:,1], D )
+    parent = mesh.get_parent()
+
+    if fast:
+        triangles = C[:,parent.get_subtriangles()].reshape(-1,3)
     else:
-        triang = tri.Triangulation( X[:,0], X[:,1], C )    
+        triangles = C[:,parent.get_edges()[:,0]]
+    triang = tri.Triangulation( X[:,0], X[:,1], triangles )
+
     #Plotting
-    plt.figure()
-    plt.tripcolor(triang, sol, edgecolors='k' )
-    
+    fig = Figure()
+    FigureCanvasAgg( fig )
+    ax = fig.add_subplot()
+    if fast:
+        image = ax.tripcolor( triang, sol, shading='gouraud', rasterized=True )
+    else:
+        image = ax.tripcolor( triang, sol, edgecolors='k' )
+
     #Plot configuration
-    plt.axis('off')
-    plt.colorbar()
+    ax.axis('off')
+    fig.colorbar( image, ax=ax )
 
     #Save the figure to the output file
-    plt.savefig( outfile )
-    
+    fig.savefig( outfile, dpi=dpi )
+
     print( 'Output written to {}'.format( outfile ) )
 
+## Plot a number of solutions in a process pool
+#  @param jobs    List of (mesh, sol, outfile) tuples
+#  @param workers Number of worker processes (default: number of CPUs)
+#  @param fast    Use the fast rasterized plot (see plot_solution)
+#  @param dpi     Resolution of the output files
+def plot_solutions( jobs, workers=None, fast=True, dpi=None ):
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor( workers ) as pool:
+        futures = [ pool.submit( plot_solution, mesh, sol, outfile, fast, dpi ) for mesh, sol, outfile in jobs ]
+        for future in futures:
+            future.result()
+
     ## Geometry Factor
 def getdata(mesh, sol, cons, params):
-    geometry_factor(mesh, sol, cons, params)
+    return geometry_factor(mesh, sol, cons, params)
     
     
\ No newline at end of file
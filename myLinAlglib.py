@@ -2,21 +2,138 @@
 #  This module contains the linear system class
 
 import numpy
+import inspect
 import scipy.sparse
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import splu, spilu, cg, minres, LinearOperator
+from myProfilelib import profiled, stage, count, annotate
+
+## Dictionary of iterative solvers
+iterative_solvers = { 'cg' : cg, 'minres' : minres }
+
+## Iterative solvers that stop on an estimate instead of the residual norm
+estimate_solvers = ( 'minres', )
+
+## Sparsity pattern of a finite element matrix
+#
+#  The CSR structure is determined once from the element connectivity,
+#  together with a scatter map that gives for every entry of every element
+#  matrix the position in the CSR data array.
+class SparsityPattern:
+
+    ## Constructor
+    #  @param size         Number of degrees of freedom
+    #  @param connectivity Matrix (int) (nelems,ndofs) of element degrees of freedom
+    def __init__ ( self, size, connectivity ):
+        C = numpy.asarray( connectivity )
+        rows = numpy.repeat( C, C.shape[1], axis=1 ).ravel()
+        cols = numpy.tile( C, (1,C.shape[1]) ).ravel()
+        keys, scatter = numpy.unique( rows*size+cols, return_inverse=True )
+
+        self.__size         = size
+        self.__connectivity = C
+        self.__indices      = keys % size
+        self.__indptr       = numpy.zeros( size+1, dtype=int )
+        self.__indptr[1:]   = numpy.cumsum( numpy.bincount( keys//size, minlength=size ) )
+        self.__scatter      = scatter.reshape( C.shape + (C.shape[1],) )
+        self.__free         = None
+
+    ## Length function
+    def __len__ ( self ):
+        return self.__size
+
+    ## Get the number of nonzero entries
+    def get_nnz ( self ):
+        return len(self.__indices)
+
+    ## Get the element connectivity the pattern was built from
+    def get_connectivity ( self ):
+        return self.__connectivity
+
+    ## Get the CSR row pointers
+    def get_indptr ( self ):
+        return self.__indptr
+
+    ## Get the CSR column indices
+    def get_indices ( self ):
+        return self.__indices
+
+    ## Get the element-to-nonzero scatter map
+    #  @return Array (int) (nelems,ndofs,ndofs) of positions in the CSR data array
+    def get_scatter ( self ):
+        return self.__scatter
+
+    ## Check if element blocks match the pattern connectivity
+    #  @param dofs Matrix (int) (nelems,ndofs) of element degrees of freedom
+    def matches ( self, dofs ):
+        return numpy.array_equal( dofs, self.__connectivity )
+
+    ## Add element matrices to a CSR data array
+    #  @param data Vector of CSR data values
+    #  @param mats Array (nelems,ndofs,ndofs) of element matrices
+    def scatter_add ( self, data, mats ):
+        data += numpy.bincount( self.__scatter.ravel(), weights=mats.ravel(), minlength=len(data) )
+
+    ## Get the selection of the free block of the pattern
+    #
+    #  The selection is computed once per set of free degrees of freedom.
+    #
+    #  @param  free Vector (bool) marking the free degrees of freedom
+    #  @return      Vector (int) of positions in the CSR data array of the
+    #               entries in the free block, in CSR order of the free block
+    #  @return      CSR column indices of the free block
+    #  @return      CSR row pointers of the free block
+    def get_free_block ( self, free ):
+        if self.__free is None or not numpy.array_equal( self.__free[0], free ):
+            index = numpy.cumsum( free ) - 1
+            rows  = numpy.repeat( numpy.arange( self.__size ), numpy.diff( self.__indptr ) )
+            selection = numpy.flatnonzero( free[rows] & free[self.__indices] )
+            indptr = numpy.zeros( free.sum()+1, dtype=int )
+            indptr[1:] = numpy.cumsum( numpy.bincount( index[rows[selection]], minlength=free.sum() ) )
+            self.__free = ( free.copy(), selection, index[self.__indices[selection]], indptr )
+        return self.__free[1:]
+
+    ## Build a CSR matrix with the pattern structure
+    #  @param data Vector of CSR data values
+    def to_csr ( self, data ):
+        return scipy.sparse.csr_matrix( (data,self.__indices,self.__indptr), shape=(self.__size,)*2 )
 
 ## Linear system of equations
+#
+#  The left-hand-side is collected as (row, column, value) triplets in
+#  preallocated arrays, which are converted to a CSR matrix (summing
+#  duplicate entries) only when the matrix is needed. If a SparsityPattern
+#  is given, element blocks with the pattern connectivity are added directly
+#  to the CSR data array instead.
 class LinearSystem:
     
     ## Constructor
     #  @param size     Number of degrees of freedom
     #  @param zerocons Indices of constrained degrees of freedom
-    def __init__ ( self, size, zerocons ):
+    #  @param nnz      Expected number of left-hand-side triplets (optional)
+    #  @param pattern  Sparsity pattern of the left-hand-side (optional)
+    def __init__ ( self, size, zerocons, nnz=None, pattern=None ):
         self.__size = size
         self.__rhs = numpy.zeros( size )
-        self.__lhs = scipy.sparse.lil_matrix( (size,size) )
         self.__cons = numpy.zeros( size, dtype=bool )
         self.__cons[zerocons] = True
+
+        #Numbering of the free degrees of freedom (-1 if constrained)
+        self.__free = numpy.flatnonzero( ~self.__cons )
+        self.__free_index = numpy.full( size, -1, dtype=int )
+        self.__free_index[self.__free] = numpy.arange( len(self.__free) )
+        self.__pattern = pattern
+        if pattern is not None:
+            assert len(pattern)==size
+            self.__data = numpy.zeros( pattern.get_nnz() )
+        capacity = nnz if nnz is not None else 0 if pattern is not None else 9*size
+        self.__rows = numpy.empty( capacity, dtype=int   )
+        self.__cols = numpy.empty( capacity, dtype=int   )
+        self.__vals = numpy.empty( capacity, dtype=float )
+        self.__ntrip = 0
+        self.__lhs = None
+        self.__lhs_free = None
+        self.__factor = None
+        self.__info = None
     
     ## Length function  
     def __len__ ( self ):
@@ -42,15 +159,437 @@ class LinearSystem:
     #  @param rdofs Row degrees of freedom to add to
     #  @param cdofs Column degrees of freedom to add to
     def add_to_lhs ( self, mat, rdofs, cdofs=None ):
-        if not cdofs:
+        if cdofs is None:
             cdofs = rdofs
-        self.__lhs[numpy.ix_(rdofs,cdofs)] += mat
+        rows = numpy.repeat( rdofs, len(cdofs) )
+        cols = numpy.tile( cdofs, len(rdofs) )
+        self.__add_triplets( rows, cols, numpy.ravel( mat ) )
+
+    ## Add a batch of element contributions to the linear system
+    #  @param vecs Matrix (nelems,ndofs) to be added to the right-hand-side
+    #  @param mats Array (nelems,ndofs,ndofs) to be added to the left-hand-side
+    #  @param dofs Matrix (int) (nelems,ndofs) of element degrees of freedom
+    def add_blocks ( self, vecs, mats, dofs ):
+        dofs = numpy.asarray( dofs )
+        self.__rhs += numpy.bincount( dofs.ravel(), weights=vecs.ravel(), minlength=len(self) )
+        if self.__pattern is not None and self.__pattern.matches( dofs ):
+            self.__pattern.scatter_add( self.__data, mats )
+            self.__lhs = self.__lhs_free = self.__factor = None
+            return
+        rows = numpy.repeat( dofs, dofs.shape[1], axis=1 ).ravel()
+        cols = numpy.tile( dofs, (1,dofs.shape[1]) ).ravel()
+        self.__add_triplets( rows, cols, mats.ravel() )
+
+    ## Get the right-hand-side vector
+    def get_rhs ( self ):
+        return self.__rhs
+
+    ## Get the left-hand-side matrix
+    #  @return Sparse (CSR) matrix with the duplicate triplets summed
+    def get_lhs ( self ):
+        if self.__lhs is None:
+            n = self.__ntrip
+            lhs = scipy.sparse.coo_matrix( (self.__vals[:n],(self.__rows[:n],self.__cols[:n])), shape=(len(self),)*2 )
+            if self.__pattern is None:
+                self.__lhs = lhs.tocsr()
+            elif n==0:
+                self.__lhs = self.__pattern.to_csr( self.__data )
+            else:
+                self.__lhs = self.__pattern.to_csr( self.__data ) + lhs.tocsr()
+        return self.__lhs
+
+    ## Get the free block of the left-hand-side
+    #
+    #  The block of free (unconstrained) degrees of freedom is built directly
+    #  from the triplets, and the pattern data by a precomputed selection,
+    #  without slicing the full matrix.
+    #
+    #  @return Sparse (CSR) matrix with the free rows and columns
+    def get_free_lhs ( self ):
+        if self.__lhs_free is None:
+            nfree = len(self.__free)
+            n     = self.__ntrip
+            rows  = self.__free_index[self.__rows[:n]]
+            cols  = self.__free_index[self.__cols[:n]]
+            keep  = ( rows >= 0 ) & ( cols >= 0 )
+            lhs   = scipy.sparse.coo_matrix( (self.__vals[:n][keep],(rows[keep],cols[keep])), shape=(nfree,nfree) )
+            if self.__pattern is None:
+                self.__lhs_free = lhs.tocsr()
+            else:
+                selection, indices, indptr = self.__pattern.get_free_block( ~self.__cons )
+                self.__lhs_free = scipy.sparse.csr_matrix( (self.__data[selection],indices,indptr), shape=(nfree,nfree) )
+                if keep.any():
+                    self.__lhs_free = self.__lhs_free + lhs.tocsr()
+        return self.__lhs_free
 
     ## Solve the constrained linear system of equations
-    #  @return Solution vector
-    def solve ( self ):
-        lhs_free = self.__lhs[numpy.ix_(~self.__cons,~self.__cons)]
-        rhs_free = self.__rhs[~self.__cons]
+    #  @param  method       Solution method: 'direct', 'cg' (conjugate gradients)
+    #                       or 'minres'
+    #  @param  precon       Preconditioner of the iterative methods: None, 'jacobi',
+    #                       'ilu', 'ic' (incomplete Cholesky), 'amg' (smoothed
+    #                       aggregation algebraic multigrid) or 'gmg' (geometric
+    #                       multigrid, requires the prolongators)
+    #  @param  tol          Relative residual tolerance of the iterative methods
+    #  @param  maxiter      Maximum number of iterations of the iterative methods
+    #  @param  x0           Initial solution vector of the iterative methods, e.g. a
+    #                       coarse solution prolongated to this system (default: zero)
+    #  @param  prolongators List of prolongators of the free Dofs from fine to
+    #                       coarse levels of the geometric multigrid preconditioner
+    #  @return              Solution vector
+    @profiled( 'solve' )
+    def solve ( self, method='direct', precon=None, tol=1e-10, maxiter=None, x0=None, prolongators=None ):
+        lhs_free = self.get_free_lhs()
+        rhs_free = self.__rhs[self.__free]
         sol = numpy.zeros( len(self) )
-        sol[~self.__cons] = spsolve( lhs_free.tocsr(), rhs_free )
+        if method=='direct':
+            sol[self.__free] = self.get_factorization().solve( rhs_free )
+            iterations, converged = 0, True
+        else:
+            x0_free = None if x0 is None else numpy.asarray( x0, dtype=float )[self.__free]
+            sol[self.__free], iterations, converged = iterative_solve( lhs_free, rhs_free, method, precon, tol, maxiter, x0_free, prolongators )
+        residual = numpy.linalg.norm( rhs_free - lhs_free.dot( sol[self.__free] ) ) / max( numpy.linalg.norm( rhs_free ), numpy.finfo(float).tiny )
+        if method!='direct':
+            converged = residual <= tol
+        self.__info = { 'method'     : method,
+                        'precon'     : precon,
+                        'iterations' : iterations,
+                        'residual'   : residual,
+                        'converged'  : converged }
+        annotate( method=method, precon=precon, converged=converged )
+        count( 'dofs', len(rhs_free) )
+        count( 'nonzeros', lhs_free.nnz )
+        count( 'iterations', iterations )
         return sol
+
+    ## Solve the constrained system for multiple right-hand-sides
+    #
+    #  Uses the cached factorization of the free block (see get_factorization).
+    #
+    #  @param  rhss Matrix (size,nrhs) with a right-hand-side per column, or an
+    #               iterable of right-hand-side vectors
+    #  @return      Matrix (size,nrhs) with a solution per column, or a generator
+    #               of solution vectors for an iterable of right-hand-sides
+    @profiled( 'solve_many' )
+    def solve_many ( self, rhss ):
+        if isinstance( rhss, numpy.ndarray ):
+            assert rhss.ndim==2 and len(rhss)==len(self)
+            sols = numpy.zeros( rhss.shape )
+            sols[self.__free] = self.get_factorization().solve( numpy.asfortranarray( rhss[self.__free] ) )
+            return sols
+        return ( self.solve_many( rhs[:,numpy.newaxis] )[:,0] for rhs in rhss )
+
+    ## Get the factorization of the free block of the left-hand-side
+    #
+    #  The sparse LU factorization (with symmetric ordering and pivoting on the
+    #  diagonal, i.e. a Cholesky-like factorization for symmetric positive
+    #  definite systems) is computed on the first call and kept until the
+    #  left-hand-side is changed.
+    #
+    #  @return SuperLU object of the free block
+    def get_factorization ( self ):
+        if self.__factor is None:
+            with stage( 'factorize' ):
+                self.__factor = splu( self.get_free_lhs().tocsc(), permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0., options={ 'SymmetricMode' : True } )
+                count( 'nonzeros', self.__factor.nnz )
+        return self.__factor
+
+    ## Get the free (unconstrained) Dofs
+    #  @return Vector (int) of the indices of the free Dofs
+    def get_free_dofs ( self ):
+        return self.__free
+
+    ## Get information on the last solve
+    #  @return Dictionary with the method, preconditioner, number of iterations,
+    #          relative residual norm and convergence flag
+    def get_solver_info ( self ):
+        return self.__info
+
+    ## Append triplets to the left-hand-side
+    #  @param rows Row indices
+    #  @param cols Column indices
+    #  @param vals Values
+    def __add_triplets ( self, rows, cols, vals ):
+        n = self.__ntrip + len(vals)
+        if n > len(self.__vals):
+            self.__reserve( max( n, 2*len(self.__vals) ) )
+        self.__rows[self.__ntrip:n] = rows
+        self.__cols[self.__ntrip:n] = cols
+        self.__vals[self.__ntrip:n] = vals
+        self.__ntrip = n
+        self.__lhs = self.__lhs_free = self.__factor = None
+
+    ## Grow the triplet arrays
+    #  @param capacity Number of triplets that fit in the arrays
+    def __reserve ( self, capacity ):
+        n = self.__ntrip
+        self.__rows = numpy.concatenate( (self.__rows[:n],numpy.empty( capacity-n, dtype=int   )) )
+        self.__cols = numpy.concatenate( (self.__cols[:n],numpy.empty( capacity-n, dtype=int   )) )
+        self.__vals = numpy.concatenate( (self.__vals[:n],numpy.empty( capacity-n, dtype=float )) )
+
+## Solve a linear system of equations iteratively
+#
+#  The convergence is checked on the true relative residual norm. Solvers
+#  that stop on another criterion (MINRES uses a backward error estimate)
+#  get no tolerance of their own and are stopped from the callback as soon
+#  as the true residual meets the tolerance. A solver that still stops
+#  early is restarted from its result, as a last resort, until the
+#  tolerance is met, the maximum number of iterations is reached or a
+#  restart does not reduce the residual.
+#
+#  @param  A       Sparse matrix
+#  @param  b       Right-hand-side vector
+#  @param  method  Iterative method: 'cg' or 'minres'
+#  @param  precon  Name of the preconditioner (see get_preconditioner)
+#  @param  tol     Relative residual tolerance
+#  @param  maxiter Maximum number of iterations
+#  @param  x0      Initial guess (optional)
+#  @param  prolongators Prolongators of the geometric multigrid preconditioner
+#  @return         Solution vector
+#  @return         Number of iterations
+#  @return         Convergence flag (relative residual norm below tol)
+def iterative_solve ( A, b, method, precon, tol, maxiter, x0=None, prolongators=None ):
+    if method not in iterative_solvers:
+        raise RuntimeError( 'Unknown solution method %s' % method )
+    solver = iterative_solvers[method]
+
+    #The tolerance argument was renamed in newer SciPy versions
+    tolname = 'rtol' if 'rtol' in inspect.signature( solver ).parameters else 'tol'
+
+    bnorm = max( numpy.linalg.norm( b ), numpy.finfo(float).tiny )
+    check = method in estimate_solvers
+    iterations = [0]
+    solution   = [None]
+    def callback ( xk ):
+        iterations[0] += 1
+        if check and numpy.linalg.norm( b - A.dot( xk ) ) <= tol * bnorm:
+            solution[0] = numpy.array( xk )
+            raise ToleranceReached
+
+    M = get_preconditioner( A, precon, prolongators )
+    x, residual = x0, numpy.inf
+    while True:
+        remaining = None if maxiter is None else maxiter - iterations[0]
+        try:
+            x, info = solver( A, b, x0=x, maxiter=remaining, M=M, callback=callback, **{ tolname : 0. if check else tol } )
+        except ToleranceReached:
+            x, info = solution[0], 0
+        if info < 0:
+            raise RuntimeError( 'Iterative solver %s failed (info %d)' % ( method, info ) )
+        previous, residual = residual, numpy.linalg.norm( b - A.dot( x ) ) / bnorm
+        if residual <= tol or residual >= previous or ( maxiter is not None and iterations[0] >= maxiter ):
+            break
+    return x, iterations[0], residual <= tol
+
+## Signal from a solver callback that the tolerance is reached
+class ToleranceReached ( Exception ):
+    pass
+
+## Get a preconditioner
+#  @param  A            Sparse symmetric positive definite matrix
+#  @param  precon       Name of the preconditioner: None, 'jacobi', 'ilu', 'ic',
+#                       'amg' or 'gmg'
+#  @param  prolongators List of prolongators from fine to coarse of the
+#                       geometric multigrid preconditioner ('gmg')
+#  @return              Preconditioner as a LinearOperator (None without preconditioner)
+def get_preconditioner ( A, precon, prolongators=None ):
+    if precon is None:
+        return None
+    elif precon=='jacobi':
+        dinv = 1. / A.diagonal()
+        return LinearOperator( A.shape, matvec=lambda x : dinv * x )
+    elif precon=='ilu':
+        ilu = spilu( A.tocsc(), drop_tol=1e-4, fill_factor=10 )
+        return LinearOperator( A.shape, matvec=ilu.solve )
+    elif precon=='ic':
+        lu = splu( incomplete_cholesky( A ).tocsc(), permc_spec='NATURAL', diag_pivot_thresh=0. )
+        return LinearOperator( A.shape, matvec=lambda x : lu.solve( lu.solve( x ), trans='T' ) )
+    elif precon=='amg':
+        prolongators, operators = smoothed_aggregation( A )
+        return MultigridPreconditioner( A, prolongators, operators ).as_operator()
+    elif precon=='gmg':
+        if not prolongators:
+            raise RuntimeError( 'Preconditioner gmg requires the prolongators' )
+        return MultigridPreconditioner( A, prolongators ).as_operator()
+    raise RuntimeError( 'Unknown preconditioner %s' % precon )
+
+## Incomplete Cholesky factorization without fill-in, IC(0)
+#
+#  The factor has the sparsity pattern of the lower triangle of the matrix.
+#  On breakdown (a non-positive pivot) the factorization is repeated with an
+#  increasing shift of the diagonal.
+#
+#  @param  A Sparse symmetric positive definite matrix
+#  @return   Lower triangular factor L (CSR) with A approximately L L^T
+def incomplete_cholesky ( A ):
+    A = scipy.sparse.csr_matrix( A )
+    shift = 0.
+    while True:
+        L = scipy.sparse.tril( A + shift * scipy.sparse.diags( A.diagonal() ), format='csr' )
+        L.sort_indices()
+        if ic0_factorize( L.indptr, L.indices, L.data ):
+            return L
+        shift = max( 2*shift, 1e-3 )
+
+## Factorize the lower triangle of a matrix in place with IC(0)
+#  @param  indptr  CSR row pointers of the lower triangle (sorted indices)
+#  @param  indices CSR column indices of the lower triangle
+#  @param  data    CSR values of the lower triangle, overwritten by the factor
+#  @return         False on breakdown, True otherwise
+def ic0_factorize ( indptr, indices, data ):
+    rows = []
+    for i in range( len(indptr)-1 ):
+        row = {}
+        for p in range( indptr[i], indptr[i+1] ):
+            k = indices[p]
+            rowk = rows[k] if k < i else row
+            s = data[p]
+            for j, lij in row.items():
+                lkj = rowk.get( j )
+                if lkj is not None:
+                    s -= lij * lkj
+            if k < i:
+                row[k] = s / rowk[k]
+            elif s > 0.:
+                row[k] = numpy.sqrt( s )
+            else:
+                return False
+            data[p] = row[k]
+        if i not in row:
+            return False
+        rows.append( row )
+    return True
+
+## Smoothed aggregation algebraic multigrid setup
+#
+#  The nodes are aggregated based on the strength of connection, the piecewise
+#  constant tentative prolongator is smoothed with one damped Jacobi step and
+#  the coarse operators follow from the Galerkin product P^T A P.
+#
+#  @param  A           Sparse symmetric positive definite matrix
+#  @param  theta       Strength of connection threshold
+#  @param  coarse_size Size below which no further coarsening is done
+#  @param  max_levels  Maximum number of levels
+#  @return             List of prolongators from fine to coarse
+#  @return             List of coarse operators from fine to coarse
+def smoothed_aggregation ( A, theta=0.08, coarse_size=100, max_levels=10 ):
+    prolongators = []
+    operators    = []
+    A = scipy.sparse.csr_matrix( A )
+    while A.shape[0] > coarse_size and len(prolongators) < max_levels-1:
+
+        #Tentative prolongator with normalized piecewise constant columns
+        aggregates = aggregate( strength_of_connection( A, theta ) )
+        naggs = aggregates.max() + 1
+        if naggs >= A.shape[0]:
+            break
+        scale = 1. / numpy.sqrt( numpy.bincount( aggregates ) )
+        T = scipy.sparse.csr_matrix( (scale[aggregates],(numpy.arange( A.shape[0] ),aggregates)), shape=(A.shape[0],naggs) )
+
+        #Smoothed prolongator P = (I - omega D^-1 A) T
+        DA = scipy.sparse.diags( 1. / A.diagonal() ).dot( A )
+        omega = 4. / 3. / spectral_radius( DA )
+        P = ( T - omega * DA.dot( T ) ).tocsr()
+
+        A = P.T.dot( A ).dot( P ).tocsr()
+        prolongators.append( P )
+        operators   .append( A )
+    return prolongators, operators
+
+## Determine the strong connections in a matrix
+#  @param  A     Sparse matrix (CSR)
+#  @param  theta Strength of connection threshold
+#  @return       Sparse matrix (CSR) with the strong off-diagonal connections
+def strength_of_connection ( A, theta ):
+    C = scipy.sparse.coo_matrix( A )
+    d = numpy.abs( A.diagonal() )
+    strong = ( numpy.abs( C.data ) >= theta * numpy.sqrt( d[C.row] * d[C.col] ) ) & ( C.row != C.col )
+    return scipy.sparse.csr_matrix( (C.data[strong],(C.row[strong],C.col[strong])), shape=A.shape )
+
+## Aggregate the nodes of a strength of connection graph
+#
+#  Nodes with only unaggregated strong neighbours form a new aggregate with
+#  their neighbours, remaining nodes join a neighbouring aggregate and
+#  isolated nodes form their own aggregate.
+#
+#  @param  S Sparse matrix (CSR) of strong connections
+#  @return   Vector (int) with the aggregate index of every node
+def aggregate ( S ):
+    indptr, indices = S.indptr, S.indices
+    aggregates = numpy.full( S.shape[0], -1, dtype=int )
+    naggs = 0
+    for i in range( S.shape[0] ):
+        neighbours = indices[indptr[i]:indptr[i+1]]
+        if aggregates[i] < 0 and ( aggregates[neighbours] < 0 ).all():
+            aggregates[i] = aggregates[neighbours] = naggs
+            naggs += 1
+    first = aggregates.copy()
+    for i in numpy.flatnonzero( first < 0 ):
+        neighbours = indices[indptr[i]:indptr[i+1]]
+        joined = first[neighbours][ first[neighbours] >= 0 ]
+        if len(joined) > 0:
+            aggregates[i] = joined[0]
+    isolated = numpy.flatnonzero( aggregates < 0 )
+    aggregates[isolated] = naggs + numpy.arange( len(isolated) )
+    return aggregates
+
+## Estimate the spectral radius of a matrix with power iterations
+#  @param  A     Sparse matrix
+#  @param  niter Number of power iterations
+#  @return       Estimated spectral radius
+def spectral_radius ( A, niter=20 ):
+    x = numpy.random.RandomState( 0 ).rand( A.shape[0] )
+    rho = 1.
+    for i in range( niter ):
+        y = A.dot( x )
+        rho = numpy.linalg.norm( y ) / numpy.linalg.norm( x )
+        x = y / numpy.linalg.norm( y )
+    return rho
+
+## Multigrid V-cycle preconditioner
+#
+#  Uses damped Jacobi smoothing with an equal number of pre- and
+#  post-smoothing steps, such that the preconditioner is symmetric, and a
+#  direct solve on the coarsest level.
+class MultigridPreconditioner:
+
+    ## Constructor
+    #  @param A            Sparse matrix on the finest level
+    #  @param prolongators List of prolongators from fine to coarse
+    #  @param operators    List of coarse operators (default: Galerkin products)
+    #  @param nsmooth      Number of pre- and post-smoothing steps
+    #  @param omega        Jacobi damping factor
+    def __init__ ( self, A, prolongators, operators=None, nsmooth=1, omega=2./3. ):
+        self.__operators = [ scipy.sparse.csr_matrix( A ) ]
+        for ilevel, P in enumerate( prolongators ):
+            if operators is None:
+                self.__operators.append( P.T.dot( self.__operators[-1] ).dot( P ).tocsr() )
+            else:
+                self.__operators.append( operators[ilevel] )
+        self.__prolongators = [ scipy.sparse.csr_matrix( P ) for P in prolongators ]
+        self.__dinv    = [ omega / A.diagonal() for A in self.__operators ]
+        self.__nsmooth = nsmooth
+        self.__coarse  = splu( self.__operators[-1].tocsc() )
+
+    ## Length function
+    def __len__ ( self ):
+        return len(self.__operators)
+
+    ## Apply one V-cycle
+    #  @param  b     Right-hand-side vector
+    #  @param  level Level index (0 is the finest level)
+    #  @return       Approximate solution vector
+    def vcycle ( self, b, level=0 ):
+        if level==len(self.__prolongators):
+            return self.__coarse.solve( b )
+        A, dinv, P = self.__operators[level], self.__dinv[level], self.__prolongators[level]
+        x = dinv * b
+        for i in range( self.__nsmooth-1 ):
+            x += dinv * ( b - A.dot( x ) )
+        x += P.dot( self.vcycle( P.T.dot( b - A.dot( x ) ), level+1 ) )
+        for i in range( self.__nsmooth ):
+            x += dinv * ( b - A.dot( x ) )
+        return x
+
+    ## Get the preconditioner as a linear operator
+    def as_operator ( self ):
+        return LinearOperator( self.__operators[0].shape, matvec=self.vcycle )
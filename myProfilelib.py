@@ -0,0 +1,236 @@
+## @package myProfilelib
+#  This module contains the instrumentation of the solver pipeline
+#
+#  The pipeline stages (reading, assembly, solving, boundary extraction and
+#  post-processing) are timed with stage contexts, and counters such as the
+#  number of elements, nonzeros and solver iterations are attached to the
+#  innermost running stage. Every finished stage is emitted as a JSON event
+#  on a line of its own, such that the events of batch runs can be appended
+#  to a single file.
+#
+#  The instrumentation is switched on with enable(), or through the
+#  environment variables:
+#  - MYFEM_PROFILE         Output of the events: a file name, or '1' for stderr
+#  - MYFEM_PROFILE_CAPTURE Comma separated extra captures: 'cprofile' and/or
+#                          'tracemalloc'
+#
+#  When it is off, stage() returns a shared empty context and count() and
+#  annotate() return immediately.
+
+import os
+import sys
+import json
+import time
+import functools
+import contextlib
+
+## Extra captures that can be enabled
+capture_options = ( 'cprofile', 'tracemalloc' )
+
+## Number of functions of a cProfile capture included in an event
+profile_entries = 20
+
+## Instrumentation switch
+enabled = False
+
+## Output stream of the events
+stream = None
+
+## The output stream was opened by enable
+owned = False
+
+## Enabled extra captures
+captures = ()
+
+## Stack of running stages
+running = []
+
+## Totals per stage name: number of calls and time
+totals = {}
+
+## Shared context of a disabled stage
+null_stage = contextlib.nullcontext()
+
+## Pipeline stage
+#
+#  Context manager that measures a stage and emits it as an event on exit.
+#  The outermost stage also runs the extra captures, as cProfile and
+#  tracemalloc cannot be nested.
+class Stage:
+
+    ## Constructor
+    #  @param name Name of the stage
+    #  @param info Dictionary with information on the stage
+    def __init__ ( self, name, info ):
+        self.__name     = name
+        self.__info     = dict( info )
+        self.__counters = {}
+        self.__profiler = None
+        self.__tracing  = False
+
+    ## Start the stage
+    def __enter__ ( self ):
+        self.__parent = running[-1].get_name() if running else None
+        self.__depth  = len(running)
+        running.append( self )
+
+        if self.__depth==0 and 'tracemalloc' in captures:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.__tracing = True
+        if self.__depth==0 and 'cprofile' in captures:
+            import cProfile
+            self.__profiler = cProfile.Profile()
+            self.__profiler.enable()
+
+        self.__start = time.time()
+        self.__t0    = time.perf_counter()
+        return self
+
+    ## Finish the stage and emit its event
+    def __exit__ ( self, exctype, value, traceback ):
+        seconds = time.perf_counter() - self.__t0
+        running.pop()
+
+        event = { 'event'    : 'stage',
+                  'stage'    : self.__name,
+                  'parent'   : self.__parent,
+                  'depth'    : self.__depth,
+                  'pid'      : os.getpid(),
+                  'start'    : self.__start,
+                  'time'     : seconds,
+                  'counters' : self.__counters }
+        event.update( self.__info )
+        if exctype is not None:
+            event['error'] = repr( value )
+
+        if self.__profiler is not None:
+            self.__profiler.disable()
+            event['profile'] = profile_summary( self.__profiler )
+        if self.__tracing:
+            import tracemalloc
+            event['memory_peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        total = totals.setdefault( self.__name, { 'calls' : 0, 'time' : 0. } )
+        total['calls'] += 1
+        total['time']  += seconds
+
+        emit( event )
+        return False
+
+    ## Get the name of the stage
+    def get_name ( self ):
+        return self.__name
+
+    ## Add to a counter
+    #  @param name  Name of the counter
+    #  @param value Increment
+    def count ( self, name, value ):
+        self.__counters[name] = self.__counters.get( name, 0 ) + value
+
+    ## Add information on the stage
+    #  @param info Dictionary with information on the stage
+    def annotate ( self, info ):
+        self.__info.update( info )
+
+## Switch the instrumentation on
+#  @param output  File name or stream of the events (default: stderr)
+#  @param capture Extra captures ('cprofile' and/or 'tracemalloc')
+def enable ( output=None, capture=() ):
+    global enabled, stream, captures, owned
+    for option in capture:
+        if option not in capture_options:
+            raise RuntimeError( 'Unknown profile capture %s' % option )
+    disable()
+    if output is None:
+        stream = sys.stderr
+    elif isinstance( output, str ):
+        stream = open( output, 'a', buffering=1 )
+        owned  = True
+    else:
+        stream = output
+    captures = tuple( capture )
+    enabled  = True
+
+## Switch the instrumentation off
+def disable ( ):
+    global enabled, stream, owned
+    if owned:
+        stream.close()
+    enabled = False
+    stream  = None
+    owned   = False
+
+## Check if the instrumentation is on
+def is_enabled ( ):
+    return enabled
+
+## Get a stage context
+#  @param  name Name of the stage
+#  @param  info Information on the stage, included in its event
+#  @return      Context manager of the stage
+def stage ( name, **info ):
+    if not enabled:
+        return null_stage
+    return Stage( name, info )
+
+## Decorator that runs a function as a stage
+#  @param  name Name of the stage
+#  @return      Function decorator
+def profiled ( name ):
+    def decorator ( func ):
+        @functools.wraps( func )
+        def wrapper ( *args, **kwargs ):
+            if not enabled:
+                return func( *args, **kwargs )
+            with Stage( name, {} ):
+                return func( *args, **kwargs )
+        return wrapper
+    return decorator
+
+## Add to a counter of the innermost running stage
+#  @param name  Name of the counter
+#  @param value Increment
+def count ( name, value=1 ):
+    if enabled and running:
+        running[-1].count( name, value )
+
+## Add information to the innermost running stage
+#  @param info Information on the stage, included in its event
+def annotate ( **info ):
+    if enabled and running:
+        running[-1].annotate( info )
+
+## Emit an event
+#  @param event Dictionary with the event, written as a line of JSON
+def emit ( event ):
+    if enabled:
+        stream.write( json.dumps( event, default=str ) + '\n' )
+
+## Get the totals per stage
+#  @return Dictionary with the number of calls and the total time per stage name
+def get_totals ( ):
+    return { name : dict( total ) for name, total in totals.items() }
+
+## Reset the totals per stage
+def reset_totals ( ):
+    totals.clear()
+
+## Summarize a cProfile capture
+#  @param  profiler cProfile profiler
+#  @return          List of the functions with the largest cumulative time,
+#                   with their number of calls, own and cumulative time
+def profile_summary ( profiler ):
+    import pstats
+    stats   = pstats.Stats( profiler ).stats
+    entries = sorted( stats.items(), key=lambda item : item[1][3], reverse=True )[:profile_entries]
+    return [ { 'function' : '%s:%d(%s)' % func,
+               'calls'    : ncalls,
+               'tottime'  : tottime,
+               'cumtime'  : cumtime } for func, ( primcalls, ncalls, tottime, cumtime, callers ) in entries ]
+
+if os.environ.get( 'MYFEM_PROFILE' ):
+    enable( None if os.environ['MYFEM_PROFILE']=='1' else os.environ['MYFEM_PROFILE'],
+            [ option for option in os.environ.get( 'MYFEM_PROFILE_CAPTURE', '' ).split( ',' ) if option ] )
@@ -0,0 +1,176 @@
+## @package mybatch
+#  This module contains the batch case runner
+#
+#  Usage: python mybatch.py CASEFILE RESULTFILE [WORKERS] [PLOTDIR]
+#
+#  The case file is a JSON file with a list of cases, a JSON file with a
+#  parameter grid (a dictionary with a list of values per key) or a CSV file
+#  with a case per row. A case has the keys 'mesh', 'length', 'pressure_drop',
+#  'viscosity' and (optional) 'id'. The results are appended to a CSV table,
+#  cases already in the table are not recomputed. If a plot directory is
+#  given, every case also writes a fast plot of its solution (see
+#  myIOlib.plot_solution) from its worker process.
+
+import os
+import sys
+import csv
+import json
+import time
+import re
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from myIOlib import read_from_txt, plot_solution
+from myFElib import calculate_flow_properties
+from mymodelslib import PipeFlow
+from myProfilelib import profiled, annotate
+
+## Model parameters of a case
+case_params = ( 'length', 'pressure_drop', 'viscosity' )
+
+## Columns of the result table
+result_columns = ( 'id', 'mesh' ) + case_params + \
+                 ( 'ndofs', 'area', 'velocity', 'perimeter', 'geometry_factor',
+                   'time_read', 'time_assemble', 'time_solve', 'time_post' )
+
+## Meshes loaded by a worker process, by mesh file name
+worker_meshes = {}
+
+## Read a case file
+#  @param  fname Name of the case file (.json or .csv)
+#  @return       List of case dictionaries
+def read_cases ( fname ):
+    if fname.endswith( '.csv' ):
+        with open( fname, newline='' ) as fin:
+            cases = list( csv.DictReader( fin ) )
+    else:
+        with open( fname ) as fin:
+            cases = json.load( fin )
+        if isinstance( cases, dict ):
+            keys  = list( cases.keys() )
+            cases = [ dict( zip( keys, values ) ) for values in itertools.product( *[ cases[key] for key in keys ] ) ]
+
+    for case in cases:
+        for key in case_params:
+            case[key] = float( case[key] )
+        if not case.get( 'id' ):
+            case['id'] = get_case_id( case )
+    return cases
+
+## Get the identifier of a case
+#  @param  case Case dictionary
+#  @return      String identifying the mesh and parameters
+def get_case_id ( case ):
+    return ':'.join( [ case['mesh'] ] + [ repr( case[key] ) for key in case_params ] )
+
+## Read the identifiers of the completed cases in a result table
+#  @param  fname Name of the result table
+#  @return       Set of case identifiers
+def read_completed ( fname ):
+    if not os.path.exists( fname ):
+        return set()
+    with open( fname, newline='' ) as fin:
+        return set( row['id'] for row in csv.DictReader( fin ) )
+
+## Get a mesh, reading it once per worker process
+#  @param  fname Name of the mesh file
+#  @return       Finite element mesh
+#  @return       Indices of constrained degrees of freedom
+def get_mesh ( fname ):
+    if fname not in worker_meshes:
+        mesh, cons = read_from_txt( fname )
+        mesh.enable_geometry_cache()
+        worker_meshes[fname] = ( mesh, cons )
+    return worker_meshes[fname]
+
+## Get the name of the plot file of a case
+#  @param  case    Case dictionary
+#  @param  plotdir Directory of the plot files
+#  @return         Name of the plot file
+def get_plot_name ( case, plotdir ):
+    return os.path.join( plotdir, re.sub( r'[^\w.-]+', '_', case['id'] ) + '.png' )
+
+## Run a single case
+#  @param  case    Case dictionary
+#  @param  plotdir Directory of the plot files (default: no plots)
+#  @return         Dictionary with a row of the result table
+@profiled( 'case' )
+def run_case ( case, plotdir=None ):
+    annotate( case=case['id'] )
+    params = { key : case[key] for key in case_params }
+    times  = [ time.perf_counter() ]
+
+    mesh, cons = get_mesh( case['mesh'] )
+    times.append( time.perf_counter() )
+
+    linsys = PipeFlow( params, mesh, cons ).assemble()
+    times.append( time.perf_counter() )
+
+    sol = linsys.solve()
+    times.append( time.perf_counter() )
+
+    result = calculate_flow_properties( mesh, sol, cons, params )
+    times.append( time.perf_counter() )
+
+    row = { 'id' : case['id'], 'mesh' : case['mesh'], 'ndofs' : len(linsys.get_free_dofs()) }
+    row.update( params )
+    row.update( { key : result[key] for key in ( 'area', 'velocity', 'perimeter', 'geometry_factor' ) } )
+    for stage, t0, t1 in zip( ( 'read', 'assemble', 'solve', 'post' ), times[:-1], times[1:] ):
+        row['time_'+stage] = t1 - t0
+
+    if plotdir is not None:
+        plot_solution( mesh, sol, get_plot_name( case, plotdir ), fast=True )
+    return row
+
+## Run a list of cases in a process pool
+#
+#  The worker processes are kept for all cases, such that the imports and
+#  the meshes stay loaded. Cases are submitted ordered by mesh and every
+#  result is appended to the table as soon as it is available.
+#
+#  @param  cases   List of case dictionaries
+#  @param  outfile Name of the result table
+#  @param  workers Number of worker processes (default: number of CPUs)
+#  @param  plotdir Directory of the plot files (default: no plots)
+#  @return         Number of cases written to the table
+#  @return         Number of failed cases
+def run_cases ( cases, outfile, workers=None, plotdir=None ):
+    completed = read_completed( outfile )
+    todo = sorted( [ case for case in cases if case['id'] not in completed ], key=lambda case : case['mesh'] )
+    if not todo:
+        return 0, 0
+
+    if plotdir is not None:
+        os.makedirs( plotdir, exist_ok=True )
+
+    header = not os.path.exists( outfile )
+    with open( outfile, 'a', newline='' ) as fout, ProcessPoolExecutor( workers ) as pool:
+        writer = csv.DictWriter( fout, fieldnames=result_columns )
+        if header:
+            writer.writeheader()
+        futures = { pool.submit( run_case, case, plotdir ) : case for case in todo }
+        written = 0
+        failed  = 0
+        for future in as_completed( futures ):
+            try:
+                writer.writerow( future.result() )
+                fout.flush()
+                written += 1
+            except Exception as e:
+                failed += 1
+                print( 'Case {} failed: {}'.format( futures[future]['id'], e ), file=sys.stderr )
+    return written, failed
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3,4,5):
+        sys.exit( 'Usage: python mybatch.py CASEFILE RESULTFILE [WORKERS] [PLOTDIR]' )
+
+    t0 = time.time()
+    workers = int(sys.argv[3]) if len(sys.argv)>=4 else None
+    plotdir = sys.argv[4] if len(sys.argv)==5 else None
+    written, failed = run_cases( read_cases( sys.argv[1] ), sys.argv[2], workers, plotdir )
+    print( 'Cases written       [-]    : ', written )
+    print( 'Cases failed        [-]    : ', failed )
+    print( 'CPU time            [s]    : ', time.time()-t0 )
+
+    if failed:
+        sys.exit( '{} cases failed'.format( failed ) )
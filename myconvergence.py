@@ -0,0 +1,54 @@
+## @package myconvergence
+#  This module contains the convergence study program
+#
+#  Usage: python myconvergence.py MESHFILE [TOL] [MAXLEVELS] [EXACT] [RADIUS] [THETA]
+#
+#  Solves the pipe flow on the mesh and on uniformly refined meshes until the
+#  relative change of the geometry factor (or its error with respect to
+#  EXACT) is below TOL. For a circular pipe, RADIUS places the new boundary
+#  nodes on the circle around the origin. With THETA, the meshes are refined
+#  adaptively instead, marking the elements with the largest error indicators
+#  up to the bulk fraction THETA. Empty arguments take their default.
+
+import sys
+import numpy
+from myIOlib import read_from_txt
+from mymodelslib import convergence_study, adaptive_study
+
+## Model parameters of the study
+params = { 'length'        : 1.,
+           'pressure_drop' : 1.,
+           'viscosity'     : 1e-3 }
+
+## Get a function that projects coordinates onto a circle around the origin
+#  @param  radius Radius of the circle
+#  @return        Function mapping a matrix (n,2) of coordinates onto the circle
+def circle_projection ( radius ):
+    return lambda X : radius * X / numpy.linalg.norm( X, axis=1 )[:,numpy.newaxis]
+
+if __name__ == '__main__':
+    if not 2 <= len(sys.argv) <= 7:
+        sys.exit( 'Usage: python myconvergence.py MESHFILE [TOL] [MAXLEVELS] [EXACT] [RADIUS] [THETA]' )
+
+    args      = sys.argv[2:] + [ None ] * ( 7 - len(sys.argv) )
+    tol       = float( args[0] ) if args[0] else 1e-3
+    maxlevels = int( args[1] ) if args[1] else 5
+    exact     = float( args[2] ) if args[2] else None
+    project   = circle_projection( float( args[3] ) ) if args[3] else None
+    theta     = float( args[4] ) if args[4] else None
+
+    mesh, cons = read_from_txt( sys.argv[1] )
+    if theta is None:
+        levels, mesh, sol = convergence_study( params, mesh, cons, tol, maxlevels, exact, project )
+    else:
+        levels, mesh, sol = adaptive_study( params, mesh, cons, tol, maxlevels, theta, exact, project )
+
+    print( '{:>5} {:>8} {:>8} {:>16} {:>10} {:>6} {:>9}'.format( 'level', 'nodes', 'elements', 'geometry factor', 'error', 'rate', 'time [s]' ) )
+    for entry in levels:
+        print( '{:>5} {:>8} {:>8} {:>16.8f} {:>10} {:>6} {:>9.3f}'.format(
+               entry['level'], entry['nnodes'], entry['nelems'], entry['geometry_factor'],
+               '' if entry['error'] is None else '{:.2e}'.format( entry['error'] ),
+               '' if entry['rate'] is None else '{:.2f}'.format( entry['rate'] ), entry['time'] ) )
+
+    if not levels[-1]['converged']:
+        sys.exit( 'Tolerance not met after {} refinements'.format( maxlevels ) )
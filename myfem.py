@@ -1,4 +1,4 @@
-from myIOlib import read_from_txt, plot_solution, getdata
+from myIOlib import read_from_txt, plot_solution, write_vtu, getdata
 from mymodelslib import PipeFlow
 import time
 
@@ -7,6 +7,7 @@ t0 = time.time()
 #Define the model parameters
 meshfile = 'meshes/circle_coarse_p1.txt'
 outfile  = 'output/output.png'
+vtufile  = 'output/output.vtu'
 params   = { 'length'        : 1.,
              'pressure_drop' : 1.,
              'viscosity'     : 1e-3 }
@@ -14,6 +15,9 @@ params   = { 'length'        : 1.,
 #Read the mesh and constraints from a text file
 mesh, cons = read_from_txt( meshfile )
 
+#Reuse the element geometry in the assembly and the post-processing
+mesh.enable_geometry_cache()
+
 #Construct the finite element model
 femodel = PipeFlow( params, mesh, cons )
 
@@ -30,6 +34,8 @@ t1=time.time()
 total=t1-t0
 print("CPU time            [s]    : ", total)
 
+#Write the solution for post-processing tools
+write_vtu( vtufile, mesh, { 'velocity' : sol } )
+
 #Plot the sollution
 plot_solution( mesh, sol, outfile )
-## TODO fix for quadratic elements
\ No newline at end of file
@@ -1,8 +1,21 @@
 ## @package mymodelslib
 #  This module contains the finite element fluid flow model
 
+import os
+import math
+import time
 import numpy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from myFElib import calculate_geometry, calculate_flow_properties, calculate_error_indicators, mark_elements
 from myLinAlglib import LinearSystem
+from myProfilelib import profiled, is_enabled, count, annotate
+
+## Number of elements per chunk in the parallel assembly
+chunk_size = 4096
+
+## Shared arrays attached by a parallel assembly worker process
+worker_arrays = {}
 
 ## Fluid flow finite element model
 class PipeFlow:
@@ -13,9 +26,7 @@ class PipeFlow:
     #  @param cons   Indices of constrained degrees of freedom
     def __init__ ( self, params, mesh, cons ):
         
-        assert isinstance( params['length'], float ) and params['length'] > 0.
-        assert isinstance( params['pressure_drop'], float )
-        assert isinstance( params['viscosity'], float ) and params['viscosity'] > 0.
+        check_params( params )
         
         self.__mu    = params['viscosity']
         self.__s     = params['pressure_drop']/params['length']
@@ -23,11 +34,71 @@ class PipeFlow:
         self.__cons  = cons
 
     ## Assemble the finite element system
-    #  @return Linear system of equations
-    def assemble ( self ):
+    #  @param  mode    Assembly mode: 'batch' (all elements at once), 'loop'
+    #                  (element by element), 'parallel' (element chunks in a
+    #                  process pool) or 'threads' (element chunks in a thread pool)
+    #  @param  workers Number of workers of the parallel modes (default: number of CPUs)
+    #  @return         Linear system of equations
+    @profiled( 'assemble' )
+    def assemble ( self, mode='batch', workers=None ):
         
         #Initialize the linear system
-        linsys = LinearSystem( self.__mesh.get_nr_of_nodes(), self.__cons )
+        size = self.__mesh.get_nr_of_nodes()
+
+        if mode=='batch':
+            linsys = LinearSystem( size, self.__cons, pattern=self.__mesh.get_sparsity_pattern() )
+            self.__assemble_batch( linsys )
+        elif mode in ('parallel','threads'):
+            linsys = LinearSystem( size, self.__cons, pattern=self.__mesh.get_sparsity_pattern() )
+            self.__assemble_parallel( linsys, workers or os.cpu_count(), mode=='threads' )
+        elif mode=='loop':
+            nnz    = len(self.__mesh) * len(self.__mesh.get_parent())**2
+            linsys = LinearSystem( size, self.__cons, nnz )
+            self.__assemble_loop( linsys )
+        else:
+            raise RuntimeError( 'Unknown assembly mode %s' % mode )
+
+        if is_enabled():
+            annotate( mode=mode )
+            count( 'elements', len(self.__mesh) )
+            count( 'nonzeros', linsys.get_lhs().nnz )
+        return linsys
+
+    ## Solve the model for a sweep of parameters
+    #
+    #  The left-hand-side is assembled and factorized once per viscosity. The
+    #  load vector is assembled once for a unit pressure gradient and scaled
+    #  per case, and all cases with the same viscosity are solved in one call.
+    #
+    #  @param  cases List of dictionaries of model parameters
+    #  @return       Matrix (ncases,nnodes) with a solution vector per case
+    @profiled( 'sweep' )
+    def sweep ( self, cases ):
+
+        for params in cases:
+            check_params( params )
+
+        viscosities = numpy.array([params['viscosity'] for params in cases])
+        gradients   = numpy.array([params['pressure_drop']/params['length'] for params in cases])
+
+        geom = self.__mesh.get_geometry( 'gauss', 3 )
+        sols = numpy.zeros( (len(cases),self.__mesh.get_nr_of_nodes()) )
+
+        for mu in numpy.unique( viscosities ):
+            icases = numpy.flatnonzero( viscosities==mu )
+
+            linsys = LinearSystem( self.__mesh.get_nr_of_nodes(), self.__cons, pattern=self.__mesh.get_sparsity_pattern() )
+            erhs, elhs = element_matrices( geom, mu, 1. )
+            linsys.add_blocks( erhs, elhs, self.__mesh.get_connectivity() )
+
+            loads = numpy.outer( linsys.get_rhs(), gradients[icases] )
+            sols[icases] = linsys.solve_many( loads ).T
+
+        return sols
+
+    ## Assemble the element contributions element by element
+    #  @param linsys Linear system of equations
+    def __assemble_loop ( self, linsys ):
                
         for element in self.__mesh:
         
@@ -47,5 +118,276 @@ class PipeFlow:
                elhs += w * self.__mu * numpy.dot( G, G.T )
         
             linsys.add( erhs, elhs, element.get_dofs() )
-            
-        return linsys
+
+    ## Assemble the element contributions in parallel
+    #
+    #  The elements are split in chunks of a fixed size, independent of the
+    #  number of workers. The element kernels do not mix elements and the chunk
+    #  results are added in element order, so the result is bitwise identical
+    #  for any number of workers.
+    #
+    #  @param linsys  Linear system of equations
+    #  @param workers Number of workers
+    #  @param threads Use a thread pool (True) or a process pool with the mesh
+    #                 arrays in shared memory (False)
+    def __assemble_parallel ( self, linsys, workers, threads ):
+
+        X = numpy.ascontiguousarray( self.__mesh.get_nodal_coordinates() )
+        C = numpy.ascontiguousarray( self.__mesh.get_connectivity() )
+        parent = self.__mesh.get_parent()
+
+        starts = range( 0, len(C), chunk_size )
+        stops  = [ min( start+chunk_size, len(C) ) for start in starts ]
+        nchunk = len(starts)
+
+        if threads:
+            with ThreadPoolExecutor( workers ) as pool:
+                chunks = list( pool.map( assemble_chunk, [self.__mu]*nchunk, [self.__s]*nchunk, starts, stops, [(X,C,parent)]*nchunk ) )
+        else:
+            shared = [ share_array( X ), share_array( C ) ]
+            try:
+                with ProcessPoolExecutor( workers, initializer=init_worker, initargs=( shared[0][1], shared[1][1], parent ) ) as pool:
+                    chunks = list( pool.map( assemble_chunk, [self.__mu]*nchunk, [self.__s]*nchunk, starts, stops ) )
+            finally:
+                for block, spec in shared:
+                    block.close()
+                    block.unlink()
+
+        erhs = numpy.concatenate( [ chunk[0] for chunk in chunks ] )
+        elhs = numpy.concatenate( [ chunk[1] for chunk in chunks ] )
+        linsys.add_blocks( erhs, elhs, C )
+
+    ## Assemble the element contributions of all elements at once
+    #  @param linsys Linear system of equations
+    def __assemble_batch ( self, linsys ):
+
+        geom = self.__mesh.get_geometry( 'gauss', 3 )
+        erhs, elhs = element_matrices( geom, self.__mu, self.__s )
+        linsys.add_blocks( erhs, elhs, self.__mesh.get_connectivity() )
+
+## Calculate the pipe flow element vectors and matrices of a chunk of elements
+#  @param  mu     Viscosity
+#  @param  s      Pressure drop per unit length
+#  @param  start  Index of the first element of the chunk
+#  @param  stop   Index after the last element of the chunk
+#  @param  arrays Tuple of nodal coordinates, connectivity and parent element
+#                 (default: the arrays attached by init_worker)
+#  @return        Element vectors and matrices (see element_matrices)
+def assemble_chunk ( mu, s, start, stop, arrays=None ):
+    X, C, parent = arrays if arrays is not None else worker_arrays['arrays']
+    geom = calculate_geometry( X[C[start:stop]], parent, 'gauss', 3 )
+    return element_matrices( geom, mu, s )
+
+## Initialize a parallel assembly worker process
+#  @param coords       Shared memory name, shape and dtype of the nodal coordinates
+#  @param connectivity Shared memory name, shape and dtype of the connectivity
+#  @param parent       Standard/parent element
+def init_worker ( coords, connectivity, parent ):
+    blocks = [ shared_memory.SharedMemory( name=name ) for name, shape, dtype in (coords,connectivity) ]
+    X, C = [ numpy.ndarray( shape, dtype=dtype, buffer=block.buf ) for block, (name, shape, dtype) in zip( blocks, (coords,connectivity) ) ]
+    worker_arrays['blocks'] = blocks
+    worker_arrays['arrays'] = ( X, C, parent )
+
+## Copy an array to shared memory
+#  @param  array Array to share
+#  @return       Shared memory block
+#  @return       Tuple of the shared memory name, shape and dtype
+def share_array ( array ):
+    block = shared_memory.SharedMemory( create=True, size=max( array.nbytes, 1 ) )
+    numpy.ndarray( array.shape, dtype=array.dtype, buffer=block.buf )[...] = array
+    return block, ( block.name, array.shape, array.dtype.str )
+
+## Check the pipe flow model parameters
+#  @param params Dictionary of model parameters
+def check_params ( params ):
+    assert isinstance( params['length'], float ) and params['length'] > 0.
+    assert isinstance( params['pressure_drop'], float )
+    assert isinstance( params['viscosity'], float ) and params['viscosity'] > 0.
+
+## Calculate the pipe flow element vectors and matrices of a batch of elements
+#
+#  The integration points are summed in the same order as in the element loop.
+#
+#  @param  geom Dictionary of stacked element geometry (see myFElib.calculate_geometry)
+#  @param  mu   Viscosity
+#  @param  s    Pressure drop per unit length
+#  @return      Matrix (nelems,nnodes) of element right-hand-side vectors
+#  @return      Array (nelems,nnodes,nnodes) of element left-hand-side matrices
+def element_matrices ( geom, mu, s ):
+
+    N, G, W = geom['shapes'], geom['gradients'], geom['weights']
+    nelems, npts, nnodes = G.shape[:3]
+
+    erhs = numpy.zeros( (nelems,nnodes)        )
+    elhs = numpy.zeros( (nelems,nnodes,nnodes) )
+
+    for q in range( npts ):
+        Gq = G[:,q]
+        GG = Gq[:,:,numpy.newaxis,0] * Gq[:,numpy.newaxis,:,0] \
+           + Gq[:,:,numpy.newaxis,1] * Gq[:,numpy.newaxis,:,1]
+        erhs += W[:,q,numpy.newaxis] * s * N[q]
+        elhs += W[:,q,numpy.newaxis,numpy.newaxis] * mu * GG
+
+    return erhs, elhs
+
+## Run a convergence study of the geometry factor under uniform refinement
+#
+#  The model is solved on the mesh and on successively refined meshes (see
+#  Mesh.refine). The error of a level is relative to the exact geometry
+#  factor if it is given, and otherwise relative to the previous level.
+#  The rate is the order of the error with respect to the element size, which
+#  halves per level. The study stops at the first level with an error below
+#  the tolerance.
+#
+#  @param  params    Dictionary of model parameters
+#  @param  mesh      Finite element mesh of the first level
+#  @param  cons      Indices of constrained Dofs of the first level
+#  @param  tol       Tolerance of the relative error
+#  @param  maxlevels Maximum number of refinements
+#  @param  exact     Exact geometry factor (optional)
+#  @param  project   Function mapping new boundary nodes onto the exact
+#                    boundary (see Mesh.refine)
+#  @return           List with a dictionary per level with the 'level',
+#                    'nnodes', 'nelems', 'geometry_factor', 'error', 'rate',
+#                    'converged' and 'time'
+#  @return           Finite element mesh of the last level
+#  @return           Solution vector of the last level
+def convergence_study ( params, mesh, cons, tol=1e-3, maxlevels=5, exact=None, project=None ):
+    check_params( params )
+
+    levels = []
+    for level in range( maxlevels+1 ):
+        t0 = time.perf_counter()
+        if level > 0:
+            mesh, cons = mesh.refine( cons, project )
+        sol = PipeFlow( params, mesh, cons ).assemble().solve()
+        factor = calculate_flow_properties( mesh, sol, cons, params )['geometry_factor']
+
+        error    = study_error( factor, levels, exact )
+        previous = levels[-1]['error'] if levels else None
+        rate = math.log2( previous / error ) if previous and error else None
+
+        levels.append( { 'level'           : level,
+                         'nnodes'          : mesh.get_nr_of_nodes(),
+                         'nelems'          : len(mesh),
+                         'geometry_factor' : factor,
+                         'error'           : error,
+                         'rate'            : rate,
+                         'converged'       : error is not None and error <= tol,
+                         'time'            : time.perf_counter() - t0 } )
+        if levels[-1]['converged']:
+            break
+
+    return levels, mesh, sol
+
+## Run an adaptive refinement study of the geometry factor
+#
+#  The model is solved, the elements are marked by their gradient recovery
+#  error indicators (see myFElib.calculate_error_indicators and
+#  mark_elements) and refined by longest-edge bisection (see Mesh.bisect),
+#  until the error of the geometry factor is below the tolerance. The error
+#  is relative to the exact geometry factor if it is given, and otherwise
+#  relative to the previous step. The rate is the order of the error with
+#  respect to the square root of the number of nodes, i.e. the order in the
+#  element size of a uniform mesh.
+#
+#  @param  params   Dictionary of model parameters
+#  @param  mesh     Finite element mesh of the first step
+#  @param  cons     Indices of constrained Dofs of the first step
+#  @param  tol      Tolerance of the relative error
+#  @param  maxsteps Maximum number of refinements
+#  @param  theta    Bulk fraction of the marking
+#  @param  exact    Exact geometry factor (optional)
+#  @param  project  Function mapping new boundary nodes onto the exact
+#                   boundary (see Mesh.bisect)
+#  @return          List with a dictionary per step with the 'level',
+#                   'nnodes', 'nelems', 'geometry_factor', 'estimate' (norm
+#                   of the error indicators), 'error', 'rate', 'converged'
+#                   and 'time'
+#  @return          Finite element mesh of the last step
+#  @return          Solution vector of the last step
+def adaptive_study ( params, mesh, cons, tol=1e-3, maxsteps=20, theta=0.5, exact=None, project=None ):
+    check_params( params )
+
+    levels = []
+    for level in range( maxsteps+1 ):
+        t0 = time.perf_counter()
+        if level > 0:
+            mesh, cons = mesh.bisect( mark_elements( indicators, theta ), cons, project )
+        sol = PipeFlow( params, mesh, cons ).assemble().solve()
+        factor = calculate_flow_properties( mesh, sol, cons, params )['geometry_factor']
+        indicators = calculate_error_indicators( mesh, sol )
+
+        error    = study_error( factor, levels, exact )
+        previous = levels[-1] if levels else None
+        rate = 2 * math.log( previous['error'] / error ) / math.log( mesh.get_nr_of_nodes() / previous['nnodes'] ) \
+               if previous and previous['error'] and error else None
+
+        levels.append( { 'level'           : level,
+                         'nnodes'          : mesh.get_nr_of_nodes(),
+                         'nelems'          : len(mesh),
+                         'geometry_factor' : factor,
+                         'estimate'        : numpy.sqrt( ( indicators**2 ).sum() ),
+                         'error'           : error,
+                         'rate'            : rate,
+                         'converged'       : error is not None and error <= tol,
+                         'time'            : time.perf_counter() - t0 } )
+        if levels[-1]['converged']:
+            break
+
+    return levels, mesh, sol
+
+## Solve the pipe flow on a hierarchy of nested meshes
+#
+#  The coarsest level is solved directly. Every finer level is solved
+#  iteratively, starting from the solution of the previous level
+#  interpolated with the prolongation of the mesh (see Mesh.get_prolongation).
+#  With the 'gmg' preconditioner, the prolongations of all coarser levels,
+#  restricted to the free Dofs, form a geometric multigrid V-cycle.
+#
+#  @param  params Dictionary of model parameters
+#  @param  meshes List of meshes from coarse to fine, each refined from the
+#                 previous one (see Mesh.refine and Mesh.bisect)
+#  @param  conses List of the indices of constrained Dofs of every mesh
+#  @param  method Iterative solution method of the finer levels
+#  @param  precon Preconditioner of the finer levels (see LinearSystem.solve)
+#  @param  tol    Relative residual tolerance of the finer levels
+#  @param  warm   Start the finer levels from the coarse solution
+#  @return        List of solution vectors per level
+#  @return        List of the solver information per level (see
+#                 LinearSystem.get_solver_info), including the 'time'
+def nested_solve ( params, meshes, conses, method='cg', precon='gmg', tol=1e-10, warm=True ):
+    check_params( params )
+
+    sols, infos, prolongators = [], [], []
+    for level, ( mesh, cons ) in enumerate( zip( meshes, conses ) ):
+        t0 = time.perf_counter()
+        linsys = PipeFlow( params, mesh, cons ).assemble()
+        free = linsys.get_free_dofs()
+        if level==0:
+            sol = linsys.solve()
+        else:
+            if mesh.get_refinement() is None or mesh.get_refinement()['coarse'] is not meshes[level-1]:
+                raise RuntimeError( 'Mesh %d is not refined from mesh %d' % ( level, level-1 ) )
+            P = mesh.get_prolongation()
+            prolongators.insert( 0, P[free][:,coarse_free] )
+            sol = linsys.solve( method, precon, tol, x0=P.dot( sols[-1] ) if warm else None, prolongators=prolongators )
+        coarse_free = free
+
+        sols.append( sol )
+        infos.append( dict( linsys.get_solver_info(), time=time.perf_counter() - t0 ) )
+
+    return sols, infos
+
+## Get the relative error of the geometry factor in a study
+#  @param  factor Geometry factor of the current level
+#  @param  levels List of the previous levels of the study
+#  @param  exact  Exact geometry factor (optional)
+#  @return        Error relative to the exact geometry factor, or to the
+#                 previous level, or None for the first level without exact value
+def study_error ( factor, levels, exact ):
+    if exact is not None:
+        return abs( factor - exact ) / abs( exact )
+    elif levels:
+        return abs( factor - levels[-1]['geometry_factor'] ) / abs( factor )
+    return None